@@ -12,7 +12,8 @@ from pathlib import Path
 
 from .exceptions import BeaconAccesLevelsError, BeaconServerError, BeaconAccessLevelsBadRequest
 from .. import __id__, __beacon_name__, __apiVersion__
-from ..utils.polyvalent_functions import find_yml_and_load
+from ..conf.config import DB_ACQUIRE_TIMEOUT
+from ..utils.polyvalent_functions import find_yml_and_load, reversed_host
 
 LOG = logging.getLogger(__name__)
 """Load the logging configurations from a YAML file."""
@@ -140,26 +141,25 @@ async def special_datasets(db_pool):
   They are stored in the dataset_access_level_table in the DB.
   Return two dicts prepared to be shown in the response (one for displayDatasetDifferences=false, the other for true).
   """
-  async with db_pool.acquire(timeout=180) as connection:
+  async with db_pool.acquire(timeout=DB_ACQUIRE_TIMEOUT) as connection:
     datasets = []
     try:
       query = """SELECT dt.stable_id, al.parent_field, al.field, al.access_level FROM dataset_access_level_table al
                JOIN beacon_dataset dt ON al.dataset_id=dt.id;"""
       LOG.debug(f"QUERY to fetch special datasets access levels info: {query}")
-      statement = await connection.prepare(query)
-      db_response =  await statement.fetch()
+      db_response = await connection.fetch(query)
     except Exception as e:
       raise BeaconServerError(f'Query special access levels datasets DB error: {e}') 
     
     datasets = {}
     simple_datasets = {}
-    for record in list(db_response):
+    for record in db_response:
       record_dict = dict(record)
       dataset_id = record_dict.get("stable_id")
       parent_field = record_dict.get("parent_field")
       field = record_dict.get("field")
       access_level = record_dict.get("access_level")
-      if dataset_id not in datasets.keys():
+      if dataset_id not in datasets:
         datasets[dataset_id] = {}
         datasets[dataset_id][parent_field] = {}
         datasets[dataset_id][parent_field][field] = access_level
@@ -167,7 +167,7 @@ async def special_datasets(db_pool):
           simple_datasets[dataset_id] = access_level
           datasets[dataset_id].pop("accessLevelSummary")
       else:
-        if parent_field not in datasets[dataset_id].keys():
+        if parent_field not in datasets[dataset_id]:
           datasets[dataset_id][parent_field] = {}
           datasets[dataset_id][parent_field][field] = access_level
         else:
@@ -237,7 +237,7 @@ async def access_levels_terms_handler(db_pool, processed_request, request):
     access_level_fields, special_datasets = await get_access_levels(request, processed_request, db_pool)
 
     beacon_answer = {        
-        'id': '.'.join(reversed(request.host.split('.'))),
+        'id': reversed_host(request.host),
         'name': __beacon_name__,
         'apiVersion': __apiVersion__,
         'fields': access_level_fields,
@@ -5,17 +5,16 @@ This endpoint is specific for querying all variants that appear in a certain reg
 parameters accepted by the request differ from the ones in the basic query endpoint.
 """
 
-import ast
+import asyncio
 import logging
-import requests
 
 from .exceptions import BeaconBadRequest, BeaconServerError, BeaconForbidden, BeaconUnauthorised
 from .. import __apiVersion__
-from ..conf.config import DB_SCHEMA
+from ..conf.config import DB_SCHEMA, DB_ACQUIRE_TIMEOUT
 
-from ..utils.polyvalent_functions import create_prepstmt_variables, filter_exists, datasetHandover
-from ..utils.polyvalent_functions import prepare_filter_parameter, parse_filters_request
-from ..utils.polyvalent_functions import fetch_datasets_access, access_resolution
+from ..utils.polyvalent_functions import filter_exists, datasetHandover, reversed_host, fetch_cellbase, fetch_dbsnp
+from ..utils.polyvalent_functions import prepare_filter_parameter, parse_filters_request, QUERY_PARAMETERS_SPEC
+from ..utils.polyvalent_functions import fetch_datasets_access, fetch_datasets_metadata, access_resolution, ANNOTATIONS_CONCURRENCY
 
 from ..utils.polyvalent_functions import filter_response
 from .access_levels import ACCESS_LEVELS_DICT
@@ -50,15 +49,14 @@ def snp_resultsHandover(variantId):
 
     return resultsHandover
 
-async def variantAnnotations(variant_details):
+async def variantAnnotations(http_session, variant_details):
     """
     Create the variantAnnotations response by fetching the cellBase API and the dbSNP API.
     The variant_id has to be in the following format: chrom:start:ref:alt. 
     If in the variantDetails the alt is null, it has to be changed to a '-'.
+    When the variantId is already known, both APIs are fetched concurrently.
     """
 
-    variantAnnotations = {}
-    
     # cellBase
     chrom = variant_details.get("chromosome")
     start = variant_details.get("start")
@@ -66,20 +64,23 @@ async def variantAnnotations(variant_details):
     alt = variant_details.get("alternateBases") if variant_details.get("alternateBases") else '-'
 
     variant_id = ":".join([str(chrom), str(start + 1), ref, alt])
-    url = f"http://cellbase.clinbioinfosspa.es/cb/webservices/rest/v4/hsapiens/genomic/variant/{variant_id}/annotation"
-    r = requests.get(url)
-    cellBase_dict = r.json()
+
+    # dbSNP
+    rsID = variant_details.get("variantId")
+    if rsID and rsID != ".":
+        cellBase_dict, dnSNP_dict = await asyncio.gather(fetch_cellbase(http_session, variant_id),
+                                                         fetch_dbsnp(http_session, rsID))
+        return rsID, cellBase_dict, dnSNP_dict
+
+    # Without a variantId we need the cellBase answer to know which rsID to look for in dbSNP
+    cellBase_dict = await fetch_cellbase(http_session, variant_id)
     try:
-        cellBase_rsID = cellBase_dict["response"][0]["result"][0]["id"]
+        rsID = cellBase_dict["response"][0]["result"][0]["id"]
     except:
-        cellBase_rsID = None
+        rsID = None
 
-    # dbSNP
-    rsID = variant_details.get("variantId") if variant_details.get("variantId") != "." else cellBase_rsID
     if rsID:
-        url = f"https://api.ncbi.nlm.nih.gov/variation/v0/beta/refsnp/{rsID[2:]}"
-        r = requests.get(url)
-        dnSNP_dict = r.json()
+        dnSNP_dict = await fetch_dbsnp(http_session, rsID)
     else:
         dnSNP_dict = ''
 
@@ -90,97 +91,75 @@ async def variantAnnotations(variant_details):
 #                                         FORMATTING
 # ----------------------------------------------------------------------------------------------------------------------
 
+def _or(record, key, default=''):
+    """Return the value of the key in the record, or the default if it is missing or NULL."""
+    value = record.get(key)
+    return default if value is None else value
+
+
 def transform_record_cnv(record):
     """Format the record we got from the database to gather the sample and CNV specific information."""
-    response = dict(record)
     final_response = {}
-    final_response["sampleID"]= response.get("sample_id")
-    final_response["svLength"]= response.get("sv_length")
-    final_response["genotype"]= response.get("genotype")
-    final_response["copyNumberLevel"]= response.get("copyNumberLevel")
-    final_response["readDepth"]= response.get("read_depth")
-    final_response["genotypeLikelihood"]= response.get("genotype_likelihood")
-    final_response["extraInfo"]= response.get("extra_info")
-    final_response["tissue"]= response.get("tissue")
-    final_response["sex"]= response.get("sex")
-    final_response["age"]= response.get("age")
-    final_response["disease"]= response.get("disease")
-    final_response["sampleDescription"]= response.get("sample_description")
+    final_response["sampleID"]= record["sample_id"]
+    final_response["svLength"]= record["sv_length"]
+    final_response["genotype"]= record["genotype"]
+    final_response["copyNumberLevel"]= record["copy_number_level"]
+    final_response["readDepth"]= record["read_depth"]
+    final_response["genotypeLikelihood"]= record["genotype_likelihood"]
+    final_response["extraInfo"]= record["extra_info"]
+    final_response["tissue"]= record["tissue"]
+    final_response["sex"]= record["sex"]
+    final_response["age"]= record["age"]
+    final_response["disease"]= record["disease"]
+    final_response["sampleDescription"]= record["sample_description"]
 
     return final_response
                             
 
 
-async def transform_record_dataset(db_pool, record):
-    """Format the record we got from the database to adhere to the response schema."""
-
-    # Before creating the final dict, we want to get the stable_id of the dataset from the DB
-    async with db_pool.acquire(timeout=180) as connection:
-        try: 
-            query = f"""SELECT stable_id, access_type
-                        FROM beacon_dataset
-                        WHERE id={dict(record).get("dataset_id")};
-                        """
-            statement = await connection.prepare(query)
-            extra_record = await statement.fetchrow()
-        except Exception as e:
-            raise BeaconServerError(f'Query metadata (stableID) DB error: {e}') 
-
-    response = dict(record)
-
-    # Remove the dispensable parameters of the response dict if you want to return it directly  
-    # for dispensable in ["data_id", "dataset_id", "reference_genome", "chromosome", "rs_id", "reference", "type"]:
-    #     response.pop(dispensable)
+def transform_record_dataset(record, datasets_metadata):
+    """Format the record we got from the database to adhere to the response schema.
+    The stable_id and access_type of the dataset are taken from the datasets_metadata dict (see fetch_datasets_metadata).
+    """
+    extra_record = datasets_metadata[record["dataset_id"]]
 
     # Create a final_response dict with the parameters you want to show
     final_response = {}
-    dataset_name = dict(extra_record).pop("stable_id")   
+    dataset_name = extra_record["stable_id"]
     final_response["datasetId"] = dataset_name
-    final_response["internalId"] = response.pop("dataset_id")
+    final_response["internalId"] = record["dataset_id"]
     final_response["exists"] = True
-    final_response["variantCount"] = '' if response.get("variant_cnt") is None else response.pop("variant_cnt")  
-    final_response["callCount"] = '' if response.get("call_cnt") is None else response.pop("call_cnt") 
-    final_response["sampleCount"] = '' if response.get("sample_cnt") is None else response.pop("sample_cnt") 
-    final_response["frequency"] = 0 if response.get("frequency") is None else float(round(response.pop("frequency"), 4))
-    final_response["numVariants"] = 0 if response.get("num_variants") is None else response.pop("num_variants")
-    final_response["info"] = {"accessType": dict(extra_record).pop("access_type"),
-                              "matchingSampleCount": 0 if response.get("matching_sample_cnt") is None else response.pop("matching_sample_cnt")}
-    # final_response["cnvInfo"] = {
-    #                             "svLength": response.get("sv_length"),
-    #                             "genotype": response.get("genotype"),
-    #                             "copyNumberLevel": response.get("copyNumberLevel"),
-    #                             "readDepth": response.get("read_depth"),
-    #                             "genotypeLikelihood": response.get("genotype_likelihood"),
-    #                             "extraInfo": response.get("extra_info"),
-    #                             "sampleID": response.get("sample_id"),
-    #                             "tissue": response.get("tissue"),
-    #                             "sex": response.get("sex"),
-    #                             "age": response.get("age"),
-    #                             "disease": response.get("disease"),
-    #                             "sampleDescription": response.get("sample_description")
-    #                             }
-                              
+    final_response["variantCount"] = _or(record, "variant_cnt")
+    final_response["callCount"] = _or(record, "call_cnt")
+    final_response["sampleCount"] = _or(record, "sample_cnt")
+    frequency = record.get("frequency")
+    final_response["frequency"] = 0 if frequency is None else float(round(frequency, 4))
+    final_response["numVariants"] = _or(record, "num_variants", 0)
+    final_response["info"] = {"accessType": extra_record["access_type"],
+                              "matchingSampleCount": _or(record, "matching_sample_cnt", 0)}
+
     final_response["datasetHandover"] = datasetHandover(dataset_name)
     
     return final_response
 
 
-def transform_misses(record):
-    """Format the missed datasets record we got from the database to adhere to the response schema."""
+def transform_misses(extra_record):
+    """Format the missed dataset to adhere to the response schema.
+    It takes the dataset record of the datasets_metadata dict (see fetch_datasets_metadata).
+    """
     response = {}
 
-    dataset_name = dict(record).get("stableId") 
+    dataset_name = extra_record["stable_id"]
 
     response["datasetId"] = dataset_name 
-    response["internalId"] = dict(record).get("datasetId")
+    response["internalId"] = extra_record["id"]
     response["exists"] = False
-    # response["datasetId"] = ''  
     response["variantCount"] = 0
     response["callCount"] = 0
     response["sampleCount"] = 0
     response["frequency"] = 0 
     response["numVariants"] = 0 
-    response["info"] = {"accessType": dict(record).get("accessType"),
+    response["info"] = {"accessType": extra_record["access_type"],
                         "matchingSampleCount": 0 }
     response["datasetHandover"] = datasetHandover(dataset_name)
     return response
@@ -191,148 +170,123 @@ def transform_misses(record):
 #                                         MAIN QUERY TO THE DATABASE
 # ----------------------------------------------------------------------------------------------------------------------
 
-async def fetch_resulting_datasets(db_pool, processed_request, misses=False, accessible_missing=None, valid_datasets=None):
+# The query is always the same text with bound parameters, so asyncpg keeps it in the statement cache of
+# each connection and Postgres does not need to parse and plan it on every request
+CNV_HITS_QUERY = """SELECT * FROM beacon_all_data_view
+                    WHERE dataset_id = any($1::int[])
+                    AND reference_genome = $2
+                    AND reference = $3
+                    AND chromosome = $4
+                    AND ($5::int IS NULL OR start >= $5)
+                    AND ($6::int IS NULL OR "end" <= $6)
+                    AND ($7::text IS NULL OR alternate = $7)
+                    AND ($8::text IS NULL OR genotype = $8)
+                    AND ($9::int IS NULL OR copy_number_level = $9)
+                    AND ($10::int IS NULL OR sv_length = $10)
+                    AND ($11::int IS NULL OR sv_length <= $11)
+                    AND ($12::int IS NULL OR sv_length >= $12);"""
+
+
+async def fetch_resulting_datasets(connection, processed_request, valid_datasets=None):
     """Find datasets based on filter parameters.
     """
-    async with db_pool.acquire(timeout=180) as connection:
-        datasets = []
-        try: 
-            if misses:
-                if accessible_missing:
-                    query = f"""SELECT id as "datasetId", access_type as "accessType", stable_id as "stableId"
-                                FROM beacon_dataset
-                                WHERE id IN ({create_prepstmt_variables(len(accessible_missing))});
-                                """
-                    LOG.debug(f"QUERY to fetch accessible missing info: {query}")
-                    statement = await connection.prepare(query)
-                    db_response =  await statement.fetch(*accessible_missing)
-                else:
-                    return []
-            else:
-                # Gathering the variant related parameters passed in the request
-                assembly_id = '' if not processed_request.get("assemblyId") else processed_request.get("assemblyId")
-                chromosome = '' if not processed_request.get("referenceName") else processed_request.get("referenceName") 
-                reference = '' if not processed_request.get("referenceBases") else processed_request.get("referenceBases") 
-                alternate = '' if not processed_request.get("alternateBases") else processed_request.get("alternateBases")
-                genotype = '' if not processed_request.get("genotype") else processed_request.get("genotype")
-
-                start = 'null' if not processed_request.get("start") else processed_request.get("start")
-                end = 'null' if not processed_request.get("end") else processed_request.get("end")
-
-                copy_number_level = 'null' if not processed_request.get("copyNumberLevel") else processed_request.get("copyNumberLevel")
-                cnv_length = 'null' if not processed_request.get("cnvLength") else processed_request.get("cnvLength")
-                max_length = 'null' if not processed_request.get("maxLength") else processed_request.get("maxLength")
-                min_length = 'null' if not processed_request.get("minLength") else processed_request.get("minLength")
-
-                # valid_datasets = ",".join([str(i) for i in valid_datasets])
-
-                query = f"""SELECT * FROM beacon_all_data_view
-                            WHERE dataset_id IN ({valid_datasets}) 
-                            AND reference_genome = '{assembly_id}'
-                            AND reference = '{reference}'
-                            AND chromosome = '{chromosome}' 
-                            AND start >= '{start}'
-                            AND "end" <= '{end}'
-                            AND (CASE
-                                WHEN nullif('{alternate}', '') IS NOT NULL THEN alternate = '{alternate}' ELSE true
-                                END)
-                            AND (CASE
-                                WHEN nullif('{genotype}', '') IS NOT NULL THEN genotype = '{genotype}' ELSE true
-                                END)
-                            AND (CASE
-                                WHEN {copy_number_level} IS NOT NULL THEN copy_number_level = {copy_number_level} ELSE true
-                                END)    
-                            AND (CASE
-                                WHEN {cnv_length} IS NOT NULL THEN sv_length = {cnv_length} ELSE true
-                                END)
-                            AND (CASE
-                                WHEN {max_length} IS NOT NULL THEN sv_length <= {max_length} ELSE true
-                                END)
-                            AND (CASE
-                                WHEN {min_length} IS NOT NULL THEN sv_length >= {min_length} ELSE true
-                                END);"""
-
-                LOG.debug(f"QUERY to fetch hits: {query}")
-                statement = await connection.prepare(query)
-                db_response = await statement.fetch()         
-
-            for record in list(db_response):
-                processed = transform_misses(record) if misses else record
-                datasets.append(processed)
-            return datasets
-        except Exception as e:
-                raise BeaconServerError(f'Query resulting datasets DB error: {e}') 
+    try: 
+        # Gathering the variant related parameters passed in the request (absent ones are passed as NULL,
+        # while a 0 start or end is kept as a real bound)
+        LOG.debug("QUERY to fetch hits: %s", CNV_HITS_QUERY)
+        db_response = await connection.fetch(CNV_HITS_QUERY,
+                                             valid_datasets,
+                                             processed_request.get("assemblyId"),
+                                             processed_request.get("referenceBases"),
+                                             processed_request.get("referenceName"),
+                                             processed_request.get("start"),
+                                             processed_request.get("end"),
+                                             processed_request.get("alternateBases") or None,
+                                             processed_request.get("genotype") or None,
+                                             processed_request.get("copyNumberLevel"),
+                                             processed_request.get("cnvLength"),
+                                             processed_request.get("maxLength"),
+                                             processed_request.get("minLength"))
+
+        return db_response
+    except Exception as e:
+            raise BeaconServerError(f'Query resulting datasets DB error: {e}') 
     
 
-async def get_datasets(db_pool, query_parameters, include_dataset, processed_request):
+async def get_datasets(db_pool, http_session, query_parameters, include_dataset, processed_request):
     """Find datasets based on filter parameters.
     """
-    all_datasets = []
     dataset_ids = query_parameters[-2]
-    # Fetch the records of all the hit datasets
-    all_datasets = await fetch_resulting_datasets(db_pool, processed_request, valid_datasets=dataset_ids)
-    # Then parse the records to be able to separate them by variants, note that we add the hit records already transformed to form the datasetAlleleResponses
+    # Fetch the records of all the hit datasets and the stable_id and access_type of every accessible dataset
+    # at once (they are needed for both hits and misses), both queries run on the same connection
+    async with db_pool.acquire(timeout=DB_ACQUIRE_TIMEOUT) as connection:
+        all_datasets = await fetch_resulting_datasets(connection, processed_request, valid_datasets=dataset_ids)
+        datasets_metadata = await fetch_datasets_metadata(connection, dataset_ids)
+    # Then parse the records in a single pass to separate them by variants, building each variantsFound element
+    # directly and adding the hit records already transformed to form the datasetAlleleResponses
     variants_dict = {}
+    variants_hits = {}  # ids of the hit datasets of each variant
     for record in all_datasets:
         # important_parameters = map(str, [record.get("chromosome"), record.get("variant_id"), record.get("reference"), record.get("alternate"), record.get("start"), record.get("end"), record.get("variant_type")])
         # variant_identifier = "|".join(important_parameters)
-        variant_identifier = record.get("data_id")  # since in the DB we already have a column that identifies each unique variant, we don't need to do it again
-
-        if variant_identifier not in variants_dict.keys():
-            variants_dict[variant_identifier] = {}
-            variants_dict[variant_identifier]["variantDetails"] = {
-                "variantId": record.get("variant_id"),
-                "chromosome":  record.get("chromosome"),
-                "referenceBases": record.get("reference"),
-                "alternateBases": record.get("alternate"),
-                "variantType": record.get("variant_type"),
-                "start": record.get("start"), 
-                "end": record.get("end")
+        variant_identifier = record["data_id"]  # since in the DB we already have a column that identifies each unique variant, we don't need to do it again
+
+        variant = variants_dict.get(variant_identifier)
+        if variant is None:
+            variant = variants_dict[variant_identifier] = {
+                "variantDetails": {
+                    "variantId": record["rs_id"],
+                    "chromosome":  record["chromosome"],
+                    "referenceBases": record["reference"],
+                    "alternateBases": record["alternate"],
+                    "variantType": record["type"],
+                    "start": record["start"], 
+                    "end": record["end"]
+                },
+                "cnvInfo": [],
+                "datasetAlleleResponses": [],
+                "variantAnnotations": {},
+                "variantHandover": '',
+                "info": {}
             }
-            variants_dict[variant_identifier]["datasetAlleleResponses"] = []
-            variants_dict[variant_identifier]["cnvInfo"] = []
-
-            # Check if the dataset info is already there, if not add it
-            dataset_info = await transform_record_dataset(db_pool, record)
-            if dataset_info["datasetId"] not in [x["datasetId"] for x in variants_dict[variant_identifier]["datasetAlleleResponses"]]:
-                variants_dict[variant_identifier]["datasetAlleleResponses"].append(dataset_info)
-            # Add the specific info about cnv and its sample (every record)
-            variants_dict[variant_identifier]["cnvInfo"].append(transform_record_cnv(record))
-        else:
-            dataset_info = await transform_record_dataset(db_pool, record)
-            if dataset_info["datasetId"] not in [x["datasetId"] for x in variants_dict[variant_identifier]["datasetAlleleResponses"]]:
-                variants_dict[variant_identifier]["datasetAlleleResponses"].append(dataset_info)
-            variants_dict[variant_identifier]["cnvInfo"].append(transform_record_cnv(record))
+            variants_hits[variant_identifier] = set()
+
+        # Check if the dataset info is already there, if not add it
+        hits = variants_hits[variant_identifier]
+        if record["dataset_id"] not in hits:
+            hits.add(record["dataset_id"])
+            variant["datasetAlleleResponses"].append(transform_record_dataset(record, datasets_metadata))
+        # Add the specific info about cnv and its sample (every record)
+        variant["cnvInfo"].append(transform_record_cnv(record))
 
     # If the includeDatasets option is ALL or MISS we have to "create" the miss datasets (which will be tranformed also) and join them to the datasetAlleleResponses
+    # (no DB access needed, the metadata of every accessible dataset is already in datasets_metadata)
     if include_dataset in ['ALL', 'MISS']:
-        for variant in variants_dict:
-            list_hits = [record["internalId"] for record in variants_dict[variant]["datasetAlleleResponses"]]
-            list_all = list(map(int, dataset_ids.split(",")))
-            accessible_missing = [int(x) for x in list_all if x not in list_hits]
-            miss_datasets = await fetch_resulting_datasets(db_pool, processed_request, misses=True, accessible_missing=accessible_missing)
-            variants_dict[variant]["datasetAlleleResponses"] += miss_datasets
-
-    # Finally, we iterate the variants_dict to create the response
-    response = []
-    for variant in variants_dict:
-        rsID, cellBase_dict, dbSNP_dict = await variantAnnotations(variants_dict[variant]["variantDetails"])
-        if rsID: variants_dict[variant]["variantDetails"]["variantId"] = rsID
-        datasetAlleleResponses = filter_exists(include_dataset, variants_dict[variant]["datasetAlleleResponses"])
-        final_variantsFound_element = {
-            "variantDetails": variants_dict[variant]["variantDetails"],
-            "cnvInfo": variants_dict[variant]["cnvInfo"],
-            "datasetAlleleResponses": datasetAlleleResponses,
-            "variantAnnotations": {
-                "cellBase": cellBase_dict,
-                "dbSNP": dbSNP_dict
-            },
-            "variantHandover": snp_resultsHandover(rsID) if rsID else '',
-            "info": {}
+        for variant_identifier, variant in variants_dict.items():
+            hits = variants_hits[variant_identifier]
+            accessible_missing = [x for x in dataset_ids if x not in hits]
+            variant["datasetAlleleResponses"] += [transform_misses(datasets_metadata[x]) for x in accessible_missing]
+
+    # Finally, we complete the variantsFound elements in place (the annotations of all variants are fetched concurrently,
+    # but with a limited number of them in flight at the same time so the external APIs are not flooded)
+    semaphore = asyncio.Semaphore(ANNOTATIONS_CONCURRENCY)
+
+    async def limited_annotations(variant_details):
+        async with semaphore:
+            return await variantAnnotations(http_session, variant_details)
+
+    response = list(variants_dict.values())
+    annotations = await asyncio.gather(*[limited_annotations(variant["variantDetails"]) for variant in response])
+    for variant, (rsID, cellBase_dict, dbSNP_dict) in zip(response, annotations):
+        if rsID:
+            variant["variantDetails"]["variantId"] = rsID
+            variant["variantHandover"] = snp_resultsHandover(rsID)
+        variant["datasetAlleleResponses"] = filter_exists(include_dataset, variant["datasetAlleleResponses"])
+        variant["variantAnnotations"] = {
+            "cellBase": cellBase_dict,
+            "dbSNP": dbSNP_dict
         }
 
-        response.append(final_variantsFound_element)
-
     return response
     
 
@@ -340,52 +294,62 @@ async def get_datasets(db_pool, query_parameters, include_dataset, processed_req
 #                                         HANDLER FUNCTION
 # ----------------------------------------------------------------------------------------------------------------------
 
+# Static part of the response and the key that matches the name of this endpoint in the access levels dict
+BEACON_HANDOVER = [ { "handoverType" : {
+                        "id" : "CUSTOM",
+                        "label" : "Organization contact"
+                        },
+                        "note" : "Organization contact details maintaining this Beacon",
+                        "url" : "mailto:beacon.ega@crg.eu"
+                    } ]
+RESPONSE_KEY = "beconGenomicRegionRequest"
+
+
+def build_beacon_response(request, processed_request, variantsFound):
+    """Create the final beacon response for the variants found, filtered depending on the access levels."""
+    # We create the final dictionary with all the info we want to return
+    beacon_response = { 'beaconId': reversed_host(request.host),
+                        'apiVersion': __apiVersion__,
+                        'exists': bool(variantsFound),  # every variant found comes from at least one hit dataset
+                        # Error is not required and should not be shown unless exists is null
+                        # If error key is set to null it will still not validate as it has a required key errorCode
+                        # Setting this will make schema validation fail
+                        # "error": None,
+                        'request': processed_request,
+                        'variantsFound': variantsFound,
+                        'info': None,
+                        'resultsHandover': None,
+                        'beaconHandover': BEACON_HANDOVER
+                        }
+    
+    # Before returning the response we need to filter it depending on the access levels
+    beacon_response = {RESPONSE_KEY: beacon_response}  # Make sure the key matches the name in the access levels dict
+    # accessible_datasets = ["EGAD00001000740", "EGAD00001000741"]  # NOTE we use the public_datasets because authentication is not implemented yet
+    accessible_datasets = ["BO_SAMPLE"]
+    user_levels = ["PUBLIC"]  # NOTE we hardcode it because authentication is not implemented yet
+    filtered_response = filter_response(beacon_response, ACCESS_LEVELS_DICT, accessible_datasets, user_levels, region2access)
+
+    return filtered_response[RESPONSE_KEY]
+
+
+def _empty_beacon_response(request, processed_request):
+    """Create the beacon response of a query that can not find anything (there are no datasets to look into)."""
+    return build_beacon_response(request, processed_request, [])
+
+
 async def cnv_request_handler(db_pool, processed_request, request):
     """
     Execute query with SQL funciton.
     """
     # First we parse the query to prepare it to be used in the SQL function
-    # We create a list of the parameters that the SQL function needs
-    correct_parameters =  [
-	"variantType",
-	"start",
-	"startMin",
-	"startMax",
-	"end",
-	"endMin",
-	"endMax",
-	"referenceName",
-	"referenceBases",
-	"alternateBases",
-	"assemblyId",
-	"datasetIds",
-    "filters"]
-    
-    int_params = ['start', 'end', 'endMax', 'endMin', 'startMax', 'startMin']
-
-    query_parameters = []
-
-    # Iterate correct_parameters to create the query_parameters list from the processed_request 
-    # in the requiered order and with the right types
-    for param in correct_parameters:
-        query_param = processed_request.get(param)
-        if query_param:
-            if param in int_params:
-                query_parameters.append(int(query_param))
-            else:
-                query_parameters.append(str(query_param))
-        else:
-            if param in int_params:
-                query_parameters.append(None)
-            else:
-                query_parameters.append("null")
-
+    # We create the query_parameters list from the processed_request in the requiered order and with the right types
+    query_parameters = [convert(processed_request[param]) if processed_request.get(param) else default
+                        for param, convert, default in QUERY_PARAMETERS_SPEC]
 
     # At this point we have a list with the needed parameters called query_parameters, the only thing 
     # laking is to update the datasetsIds (it can be "null" or processed_request.get("datasetIds"))
 
     # Not for CNV
-    # LOG.debug(f"Correct param: {correct_parameters}")
     # LOG.debug(f"Query param: {query_parameters}")
     # LOG.debug(f"Query param types: {[type(x) for x in query_parameters]}")
 
@@ -394,6 +358,11 @@ async def cnv_request_handler(db_pool, processed_request, request):
     # there were given, those are the only ones that are checked)
     public_datasets, registered_datasets, controlled_datasets = await fetch_datasets_access(db_pool, query_parameters[-2])
 
+    # Without datasets to look into there is nothing to query (neither the DB nor the annotation services)
+    if not public_datasets:
+        LOG.info('No available datasets, skipping the query.')
+        return _empty_beacon_response(request, processed_request)
+
     ##### TEST
     # access_type, accessible_datasets = access_resolution(request, request['token'], request.host, public_datasets,
     #                                                      registered_datasets, controlled_datasets)
@@ -402,8 +371,8 @@ async def cnv_request_handler(db_pool, processed_request, request):
     ##### END TEST
 
     # NOTICE that rigth now we will just focus on the PUBLIC ones to easen the process, so we get all their 
-    # ids and add them to the query
-    query_parameters[-2] = ",".join([str(id) for id in public_datasets])
+    # ids and add them to the query (as a list of ints, it is bound as an array parameter)
+    query_parameters[-2] = public_datasets
 
     # We adapt the filters parameter to be able to use it in the SQL function (e.g. '(technology)::jsonb ?& array[''Illumina Genome Analyzer II'', ''Illumina HiSeq 2000'']')
     if query_parameters[-1] != "null":
@@ -421,39 +390,7 @@ async def cnv_request_handler(db_pool, processed_request, request):
     # LOG.info(f"Query FINAL param: {query_parameters}")
 
     LOG.info('Connecting to the DB to make the query.')
-    variantsFound = await get_datasets(db_pool, query_parameters, include_dataset, processed_request)
+    variantsFound = await get_datasets(db_pool, request.app['http_session'], query_parameters, include_dataset, processed_request)
     LOG.info('Query done.')
 
-    # Generate the variantsFound response
-
-
-    # We create the final dictionary with all the info we want to return
-    beacon_response = { 'beaconId': '.'.join(reversed(request.host.split('.'))),
-                        'apiVersion': __apiVersion__,
-                        'exists': any([dataset['exists'] for variant in variantsFound for dataset in variant["datasetAlleleResponses"]]),
-                        # Error is not required and should not be shown unless exists is null
-                        # If error key is set to null it will still not validate as it has a required key errorCode
-                        # Setting this will make schema validation fail
-                        # "error": None,
-                        'request': processed_request,
-                        'variantsFound': variantsFound,
-                        'info': None,
-                        'resultsHandover': None,
-                        'beaconHandover': [ { "handoverType" : {
-                                                "id" : "CUSTOM",
-                                                "label" : "Organization contact"
-                                                },
-                                                "note" : "Organization contact details maintaining this Beacon",
-                                                "url" : "mailto:beacon.ega@crg.eu"
-                                            } ]
-                        
-                        }
-    
-    # Before returning the response we need to filter it depending on the access levels
-    beacon_response = {"beconGenomicRegionRequest": beacon_response}  # Make sure the key matches the name in the access levels dict
-    # accessible_datasets = ["EGAD00001000740", "EGAD00001000741"]  # NOTE we use the public_datasets because authentication is not implemented yet
-    accessible_datasets = ["BO_SAMPLE"]
-    user_levels = ["PUBLIC"]  # NOTE we hardcode it because authentication is not implemented yet
-    filtered_response = filter_response(beacon_response, ACCESS_LEVELS_DICT, accessible_datasets, user_levels, region2access)
-
-    return filtered_response["beconGenomicRegionRequest"]
\ No newline at end of file
+    return build_beacon_response(request, processed_request, variantsFound)
@@ -10,6 +10,7 @@ import logging
 
 from .exceptions import BeaconServerError
 from .. import __id__, __beacon_name__, __apiVersion__
+from ..conf.config import DB_ACQUIRE_TIMEOUT
 
 LOG = logging.getLogger(__name__)
 
@@ -18,17 +19,16 @@ async def fetch_filtering_terms(db_pool):
     """Execute query for returning the filtering terms.
     """
     # Take one connection from the database pool
-    async with db_pool.acquire(timeout=180) as connection:
+    async with db_pool.acquire(timeout=DB_ACQUIRE_TIMEOUT) as connection:
         # Start a new session with the connection
         async with connection.transaction():
             try:
                 query = """SELECT ontology, term, label
                            FROM ontology_term;
                            """
-                statement = await connection.prepare(query)
-                db_response = await statement.fetch()
+                db_response = await connection.fetch(query)
                 filtering_terms_list = []
-                for record in list(db_response):
+                for record in db_response:
                     filtering_terms_list.append(dict(record))
                 return filtering_terms_list
             except Exception as e:
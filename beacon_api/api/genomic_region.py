@@ -6,16 +6,17 @@ parameters accepted by the request differ from the ones in the basic query endpo
 """
 
 import ast
+import asyncio
 import logging
-import requests
+from functools import lru_cache
 
 from .exceptions import BeaconBadRequest, BeaconServerError, BeaconForbidden, BeaconUnauthorised
 from .. import __apiVersion__
-from ..conf.config import DB_SCHEMA
+from ..conf.config import DB_SCHEMA, DB_ACQUIRE_TIMEOUT
 
-from ..utils.polyvalent_functions import create_prepstmt_variables, filter_exists, datasetHandover
-from ..utils.polyvalent_functions import prepare_filter_parameter, parse_filters_request
-from ..utils.polyvalent_functions import fetch_datasets_access, access_resolution
+from ..utils.polyvalent_functions import create_prepstmt_variables, filter_exists, datasetHandover, fetch_cellbase, fetch_dbsnp_summaries, reversed_host
+from ..utils.polyvalent_functions import prepare_filter_parameter, parse_filters_request, QUERY_PARAMETERS_SPEC
+from ..utils.polyvalent_functions import fetch_datasets_access, fetch_datasets_metadata, access_resolution, ANNOTATIONS_CONCURRENCY
 
 from ..utils.polyvalent_functions import filter_response
 from .access_levels import ACCESS_LEVELS_DICT
@@ -29,8 +30,11 @@ LOG = logging.getLogger(__name__)
 #                                         HANDOVER and extra ANNOTATION
 # ----------------------------------------------------------------------------------------------------------------------
 
+@lru_cache(maxsize=4096)
 def snp_resultsHandover(variantId):
-    """Create the resultsHanover dict by inserting the variantId into the template."""
+    """Create the resultsHanover dict by inserting the variantId into the template.
+    The same list is returned for every call with a given variantId, do not modify it.
+    """
 
     resultsHandover = [ {
                         "handoverType" : {
@@ -50,15 +54,14 @@ def snp_resultsHandover(variantId):
 
     return resultsHandover
 
-async def variantAnnotations(variant_details):
+async def variantAnnotations(http_session, variant_details):
     """
-    Create the variantAnnotations response by fetching the cellBase API and the dbSNP API.
+    Create the cellBase part of the variantAnnotations response by fetching the cellBase API and return it
+    together with the rsID of the variant (the dbSNP part is fetched in batches, see fetch_dbsnp_summaries).
     The variant_id has to be in the following format: chrom:start:ref:alt. 
     If in the variantDetails the alt is null, it has to be changed to a '-'.
     """
 
-    variantAnnotations = {}
-    
     # cellBase
     chrom = variant_details.get("chromosome")
     start = variant_details.get("start")
@@ -66,24 +69,17 @@ async def variantAnnotations(variant_details):
     alt = variant_details.get("alternateBases") if variant_details.get("alternateBases") else '-'
 
     variant_id = ":".join([str(chrom), str(start + 1), ref, alt])
-    url = f"http://cellbase.clinbioinfosspa.es/cb/webservices/rest/v4/hsapiens/genomic/variant/{variant_id}/annotation"
-    r = requests.get(url)
-    cellBase_dict = r.json()
-    try:
-        cellBase_rsID = cellBase_dict["response"][0]["result"][0]["id"]
-    except:
-        cellBase_rsID = None
-
-    # dbSNP
-    rsID = variant_details.get("variantId") if variant_details.get("variantId") != "." else cellBase_rsID
-    if rsID:
-        url = f"https://api.ncbi.nlm.nih.gov/variation/v0/beta/refsnp/{rsID[2:]}"
-        r = requests.get(url)
-        dnSNP_dict = r.json()
-    else:
-        dnSNP_dict = ''
+    cellBase_dict = await fetch_cellbase(http_session, variant_id)
+
+    # Without a variantId we need the cellBase answer to know which rsID to look for in dbSNP
+    rsID = variant_details.get("variantId")
+    if not rsID or rsID == ".":
+        try:
+            rsID = cellBase_dict["response"][0]["result"][0]["id"]
+        except:
+            rsID = None
 
-    return rsID, cellBase_dict, dnSNP_dict
+    return rsID, cellBase_dict
 
 
 # ----------------------------------------------------------------------------------------------------------------------
@@ -91,50 +87,41 @@ async def variantAnnotations(variant_details):
 # ----------------------------------------------------------------------------------------------------------------------
 
 
-async def transform_record(db_pool, record):
-    """Format the record we got from the database to adhere to the response schema."""
-
-    # Before creating the dict, we want to get the stable_id frm the DB
-    async with db_pool.acquire(timeout=180) as connection:
-        try: 
-            query = f"""SELECT stable_id, access_type
-                        FROM beacon_dataset
-                        WHERE id={dict(record).get("dataset_id")};
-                        """
-            statement = await connection.prepare(query)
-            extra_record = await statement.fetchrow()
-        except Exception as e:
-            raise BeaconServerError(f'Query metadata (stableID) DB error: {e}') 
-
-    response = dict(record)
-
-    for dispensable in ["id", "variant_id", "variant_composite_id", "chromosome", "reference", "alternate", "start", "end", "variant_type"]:
-        response.pop(dispensable)
-
-    dataset_name = dict(extra_record).pop("stable_id")   
-    response["datasetId"] = dataset_name
-    response["internalId"] = response.pop("dataset_id")
-    response["exists"] = True
-    response["variantCount"] = response.pop("variant_cnt")  
-    response["callCount"] = response.pop("call_cnt") 
-    response["sampleCount"] = response.pop("sample_cnt") 
-    response["frequency"] = 0 if response.get("frequency") is None else float(round(response.pop("frequency"), 4))
-    response["numVariants"] = 0 if response.get("num_variants") is None else response.pop("num_variants")
-    response["info"] = {"accessType": dict(extra_record).pop("access_type"),
-                        "matchingSampleCount": 0 if response.get("matching_sample_cnt") is None else response.pop("matching_sample_cnt")}
+# Counters of the hit records that are returned as they are, under their name in the response schema
+COUNTS_FIELD_MAP = (("variant_cnt", "variantCount"), ("call_cnt", "callCount"), ("sample_cnt", "sampleCount"))
+
+
+def transform_record(record, datasets_metadata):
+    """Format the record we got from the database to adhere to the response schema.
+    The stable_id and access_type of the dataset are taken from the datasets_metadata dict (see fetch_datasets_metadata).
+    """
+    extra_record = datasets_metadata[record["dataset_id"]]
+    dataset_name, access_type = extra_record["stable_id"], extra_record["access_type"]
+
+    response = {"datasetId": dataset_name, "internalId": record["dataset_id"], "exists": True}
+    response.update({new: record[old] for old, new in COUNTS_FIELD_MAP})
+    frequency = record["frequency"]
+    response["frequency"] = 0 if frequency is None else float(round(frequency, 4))
+    num_variants = record.get("num_variants")  # not returned by query_data_response for now
+    response["numVariants"] = 0 if num_variants is None else num_variants
+    matching_sample_cnt = record["matching_sample_cnt"]
+    response["info"] = {"accessType": access_type,
+                        "matchingSampleCount": 0 if matching_sample_cnt is None else matching_sample_cnt}
     response["datasetHandover"] = datasetHandover(dataset_name)
     
     return response
 
 
-def transform_misses(record):
-    """Format the missed datasets record we got from the database to adhere to the response schema."""
+def transform_misses(extra_record):
+    """Format the missed dataset to adhere to the response schema.
+    It takes the dataset record of the datasets_metadata dict (see fetch_datasets_metadata).
+    """
     response = {}
 
-    dataset_name = dict(record).get("stableId") 
+    dataset_name = extra_record["stable_id"]
 
     response["datasetId"] = dataset_name 
-    response["internalId"] = dict(record).get("datasetId")
+    response["internalId"] = extra_record["id"]
     response["exists"] = False
     # response["datasetId"] = ''  
     response["variantCount"] = 0
@@ -142,7 +129,7 @@ def transform_misses(record):
     response["sampleCount"] = 0
     response["frequency"] = 0 
     response["numVariants"] = 0 
-    response["info"] = {"accessType": dict(record).get("accessType"),
+    response["info"] = {"accessType": extra_record["access_type"],
                         "matchingSampleCount": 0 }
     response["datasetHandover"] = datasetHandover(dataset_name)
     return response
@@ -153,82 +140,92 @@ def transform_misses(record):
 #                                         MAIN QUERY TO THE DATABASE
 # ----------------------------------------------------------------------------------------------------------------------
 
-async def fetch_resulting_datasets(db_pool, query_parameters, misses=False, accessible_missing=None):
+# Built once at import time, the unchanging text lets each connection reuse its cached prepared statement.
+# The hits are grouped by variant in the DB, each row carries the variant details and the list of its hit datasets
+# (in the order returned by query_data_response)
+REGION_HITS_QUERY = f"""SELECT variant_composite_id, variant_id, chromosome, reference, alternate, start, "end", variant_type,
+                               jsonb_agg(jsonb_build_object('dataset_id', dataset_id,
+                                                            'variant_cnt', variant_cnt,
+                                                            'call_cnt', call_cnt,
+                                                            'sample_cnt', sample_cnt,
+                                                            'matching_sample_cnt', matching_sample_cnt,
+                                                            'frequency', frequency) ORDER BY hit.ordinality) AS datasets
+                        FROM {DB_SCHEMA}.query_data_response({create_prepstmt_variables(13)}) WITH ORDINALITY AS hit
+                        GROUP BY 1, 2, 3, 4, 5, 6, 7, 8
+                        ORDER BY min(hit.ordinality);"""
+
+
+async def fetch_resulting_datasets(connection, query_parameters):
     """Find datasets based on filter parameters.
+    The records are yielded as they are streamed from the DB through a cursor, so it has to be
+    iterated inside a transaction of the connection.
     """
-    async with db_pool.acquire(timeout=180) as connection:
-        datasets = []
-        try: 
-            if misses:
-                if accessible_missing:
-                    query = f"""SELECT id as "datasetId", access_type as "accessType", stable_id as "stableId"
-                                FROM beacon_dataset
-                                WHERE id IN ({create_prepstmt_variables(len(accessible_missing))});
-                                """
-                    LOG.debug(f"QUERY to fetch accessible missing info: {query}")
-                    statement = await connection.prepare(query)
-                    db_response =  await statement.fetch(*accessible_missing)
-                else:
-                    return []
-            else:
-                query = f"""SELECT * FROM {DB_SCHEMA}.query_data_response({create_prepstmt_variables(13)});"""
-                LOG.debug(f"QUERY to fetch hits: {query}")
-                statement = await connection.prepare(query)
-                db_response = await statement.fetch(*query_parameters)         
-
-            for record in list(db_response):
-                processed = transform_misses(record) if misses else record
-                datasets.append(processed)
-            return datasets
-        except Exception as e:
-                raise BeaconServerError(f'Query resulting datasets DB error: {e}') 
+    try: 
+        LOG.debug("QUERY to fetch hits: %s", REGION_HITS_QUERY)
+        async for record in connection.cursor(REGION_HITS_QUERY, *query_parameters):
+            yield record
+    except Exception as e:
+            raise BeaconServerError(f'Query resulting datasets DB error: {e}') 
     
 
-async def get_datasets(db_pool, query_parameters, include_dataset):
+async def get_datasets(db_pool, http_session, query_parameters, include_dataset):
     """Find datasets based on filter parameters.
     """
-    all_datasets = []
-    dataset_ids = query_parameters[-2]
-
-    # Fetch the records of all the hit datasets
-    all_datasets = await fetch_resulting_datasets(db_pool, query_parameters)
-
-    # Then parse the records to be able to separate them by variants, note that we add the hit records already transformed to form the datasetAlleleResponses
-    variants_dict = {}
-    for record in all_datasets:
-        #important_parameters = map(str, [record.get("chromosome"), record.get("variant_id"), record.get("reference"), record.get("alternate"), record.get("start"), record.get("end"), record.get("variant_type")])
-        #variant_identifier = "|".join(important_parameters)
-        variant_identifier = record.get("variant_composite_id")
-
-        if variant_identifier not in variants_dict.keys():
-            variants_dict[variant_identifier] = {}
-            variants_dict[variant_identifier]["variantDetails"] = {
-                "variantId": record.get("variant_id"),
-                "chromosome":  record.get("chromosome"),
-                "referenceBases": record.get("reference"),
-                "alternateBases": record.get("alternate"),
-                "variantType": record.get("variant_type"),
-                "start": record.get("start"), 
-                "end": record.get("end")
-            }
-            variants_dict[variant_identifier]["datasetAlleleResponses"] = []
-            variants_dict[variant_identifier]["datasetAlleleResponses"].append(await transform_record(db_pool, record))
-        else:
-            variants_dict[variant_identifier]["datasetAlleleResponses"].append(await transform_record(db_pool, record))
+    dataset_ids = [int(x) for x in query_parameters[-2].split(",") if x]
+
+    # Both queries run on the same connection, so it is taken from the pool only once
+    async with db_pool.acquire(timeout=DB_ACQUIRE_TIMEOUT) as connection:
+        # Fetch the stable_id and access_type of every accessible dataset at once (they are needed for both hits and misses)
+        datasets_metadata = await fetch_datasets_metadata(connection, dataset_ids)
+
+        # Then stream the variants (already grouped in the DB) and transform their hit datasets as they arrive
+        # to form the datasetAlleleResponses
+        variants_dict = {}
+        async with connection.transaction():
+            async for record in fetch_resulting_datasets(connection, query_parameters):
+                variants_dict[record["variant_composite_id"]] = {
+                    "variantDetails": {
+                        "variantId": record["variant_id"],
+                        "chromosome":  record["chromosome"],
+                        "referenceBases": record["reference"],
+                        "alternateBases": record["alternate"],
+                        "variantType": record["variant_type"],
+                        "start": record["start"], 
+                        "end": record["end"]
+                    },
+                    "datasetAlleleResponses": [transform_record(dataset, datasets_metadata) for dataset in record["datasets"]]
+                }
 
     # If  the includeDatasets option is ALL or MISS we have to "create" the miss datasets (which will be tranformed also) and join them to the datasetAlleleResponses
+    # (no DB access needed, the miss responses are the same for every variant so they are created only once)
     if include_dataset in ['ALL', 'MISS']:
+        miss_responses = {x: transform_misses(datasets_metadata[x]) for x in dataset_ids}
         for variant in variants_dict:
-            list_hits = [record["internalId"] for record in variants_dict[variant]["datasetAlleleResponses"]]
-            list_all = list(map(int, dataset_ids.split(",")))
-            accessible_missing = [int(x) for x in list_all if x not in list_hits]
-            miss_datasets = await fetch_resulting_datasets(db_pool, query_parameters, misses=True, accessible_missing=accessible_missing)
-            variants_dict[variant]["datasetAlleleResponses"] += miss_datasets
+            list_hits = {record["internalId"] for record in variants_dict[variant]["datasetAlleleResponses"]}
+            variants_dict[variant]["datasetAlleleResponses"] += [miss_responses[x] for x in dataset_ids if x not in list_hits]
+
+    # Then we fetch the annotations of all the variants concurrently, but with a limited number of them
+    # in flight at the same time so the external APIs (NCBI is rate limited) are not flooded
+    semaphore = asyncio.Semaphore(ANNOTATIONS_CONCURRENCY)
+
+    async def limited_annotations(variant_details):
+        async with semaphore:
+            return await variantAnnotations(http_session, variant_details)
+
+    # The dbSNP summaries of the variants whose rsID is already known are fetched in batches while cellBase
+    # is queried, then the ones of the rsIDs that cellBase discovered are fetched in a second round
+    known_rsIDs = {variant["variantDetails"]["variantId"] for variant in variants_dict.values()} - {None, "."}
+    annotations, dbSNP_summaries = await asyncio.gather(
+        asyncio.gather(*[limited_annotations(variants_dict[variant]["variantDetails"]) for variant in variants_dict]),
+        fetch_dbsnp_summaries(http_session, known_rsIDs, semaphore))
+    discovered_rsIDs = {rsID for rsID, _ in annotations if rsID} - known_rsIDs
+    if discovered_rsIDs:
+        dbSNP_summaries.update(await fetch_dbsnp_summaries(http_session, discovered_rsIDs, semaphore))
 
     # Finally, we iterate the variants_dict to create the response
     response = []
-    for variant in variants_dict:
-        rsID, cellBase_dict, dbSNP_dict = await variantAnnotations(variants_dict[variant]["variantDetails"])
+    for variant, (rsID, cellBase_dict) in zip(variants_dict, annotations):
+        dbSNP_dict = dbSNP_summaries.get(rsID, '')
         if rsID: variants_dict[variant]["variantDetails"]["variantId"] = rsID
         datasetAlleleResponses = filter_exists(include_dataset, variants_dict[variant]["datasetAlleleResponses"])
         final_variantsFound_element = {
@@ -256,53 +253,28 @@ async def region_request_handler(db_pool, processed_request, request):
     Execute query with SQL funciton.
     """
     # First we parse the query to prepare it to be used in the SQL function
-    # We create a list of the parameters that the SQL function needs
-    correct_parameters =  [
-	"variantType",
-	"start",
-	"startMin",
-	"startMax",
-	"end",
-	"endMin",
-	"endMax",
-	"referenceName",
-	"referenceBases",
-	"alternateBases",
-	"assemblyId",
-	"datasetIds",
-    "filters"]
-    
-    int_params = ['start', 'end', 'endMax', 'endMin', 'startMax', 'startMin']
-
-    query_parameters = []
-
-    # Iterate correct_parameters to create the query_parameters list from the processed_request 
-    # in the requiered order and with the right types
-    for param in correct_parameters:
-        query_param = processed_request.get(param)
-        if query_param:
-            if param in int_params:
-                query_parameters.append(int(query_param))
-            else:
-                query_parameters.append(str(query_param))
-        else:
-            if param in int_params:
-                query_parameters.append(None)
-            else:
-                query_parameters.append("null")
-
+    # We create the query_parameters list from the processed_request in the requiered order and with the right types
+    query_parameters = [convert(processed_request[param]) if processed_request.get(param) else default
+                        for param, convert, default in QUERY_PARAMETERS_SPEC]
 
     # At this point we have a list with the needed parameters called query_parameters, the only thing 
     # laking is to update the datasetsIds (it can be "null" or processed_request.get("datasetIds"))
 
-    LOG.debug(f"Correct param: {correct_parameters}")
-    LOG.debug(f"Query param: {query_parameters}")
-    LOG.debug(f"Query param types: {[type(x) for x in query_parameters]}")
+    LOG.debug("Query param: %s", query_parameters)
+    if LOG.isEnabledFor(logging.DEBUG):
+        LOG.debug("Query param types: %s", [type(x) for x in query_parameters])
 
     # We want to get a list of the datasets available in the database separated in three lists
     # depending on the access level (we check all of them if the user hasn't specified anything, if some
     # there were given, those are the only ones that are checked)
-    public_datasets, registered_datasets, controlled_datasets = await fetch_datasets_access(db_pool, query_parameters[-2])
+    # We also adapt the filters parameter to be able to use it in the SQL function (e.g. '(technology)::jsonb ?& array[''Illumina Genome Analyzer II'', ''Illumina HiSeq 2000'']'),
+    # both lookups are independent so they are sent to the DB at the same time
+    if query_parameters[-1] != "null":
+        (public_datasets, registered_datasets, controlled_datasets), query_parameters[-1] = await asyncio.gather(
+            fetch_datasets_access(db_pool, query_parameters[-2]),
+            prepare_filter_parameter(db_pool, query_parameters[-1]))
+    else:
+        public_datasets, registered_datasets, controlled_datasets = await fetch_datasets_access(db_pool, query_parameters[-2])
 
     ##### TEST
     # access_type, accessible_datasets = access_resolution(request, request['token'], request.host, public_datasets,
@@ -315,11 +287,6 @@ async def region_request_handler(db_pool, processed_request, request):
     # ids and add them to the query
     query_parameters[-2] = ",".join([str(id) for id in public_datasets])
 
-    # We adapt the filters parameter to be able to use it in the SQL function (e.g. '(technology)::jsonb ?& array[''Illumina Genome Analyzer II'', ''Illumina HiSeq 2000'']')
-    if query_parameters[-1] != "null":
-        processed_filters_param = await prepare_filter_parameter(db_pool, query_parameters[-1])
-        query_parameters[-1]  = processed_filters_param
-
     # We will output the datasets depending on the includeDatasetResponses parameter
     include_dataset = ""
     if processed_request.get("includeDatasetResponses"):
@@ -327,18 +294,18 @@ async def region_request_handler(db_pool, processed_request, request):
     else:
         include_dataset  = "ALL"
 
-    LOG.info(f"Query FINAL param: {query_parameters}")
+    LOG.info("Query FINAL param: %s", query_parameters)
     LOG.info('Connecting to the DB to make the query.')
-    variantsFound = await get_datasets(db_pool, query_parameters, include_dataset)
+    variantsFound = await get_datasets(db_pool, request.app['http_session'], query_parameters, include_dataset)
     LOG.info('Query done.')
 
     # Generate the variantsFound response
 
 
     # We create the final dictionary with all the info we want to return
-    beacon_response = { 'beaconId': '.'.join(reversed(request.host.split('.'))),
+    beacon_response = { 'beaconId': reversed_host(request.host),
                         'apiVersion': __apiVersion__,
-                        'exists': any([dataset['exists'] for variant in variantsFound for dataset in variant["datasetAlleleResponses"]]),
+                        'exists': any(dataset['exists'] for variant in variantsFound for dataset in variant["datasetAlleleResponses"]),
                         # Error is not required and should not be shown unless exists is null
                         # If error key is set to null it will still not validate as it has a required key errorCode
                         # Setting this will make schema validation fail
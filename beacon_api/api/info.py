@@ -17,6 +17,7 @@ from aiocache.serializers import JsonSerializer
 
 from .. import __id__, __beacon_name__, __apiVersion__, __org_id__, __org_name__, __org_description__, __org_adress__, __org_welcomeUrl__, __org_contactUrl__, __org_logoUrl__, __org_info__
 from .. import __description__, __version__, __welcomeUrl__, __alternativeUrl__, __createDateTime__, __updateDateTime__
+from ..conf.config import DB_ACQUIRE_TIMEOUT
 from .exceptions import BeaconBadRequest, BeaconServerError, BeaconBasicBadRequest
 
 from ..utils.models import GA4GH_ServiceInfo_v01, Beacon_v1, organization
@@ -59,7 +60,7 @@ async def fetch_dataset_metadata(db_pool, datasets=None, access_type=None):
     """Execute query for returning dataset metadata.
     """
     # Take one connection from the database pool
-    async with db_pool.acquire(timeout=180) as connection:
+    async with db_pool.acquire(timeout=DB_ACQUIRE_TIMEOUT) as connection:
         # Start a new session with the connection
         async with connection.transaction():
             # Fetch dataset metadata according to user request
@@ -74,11 +75,10 @@ async def fetch_dataset_metadata(db_pool, datasets=None, access_type=None):
                            coalesce(stable_id = any($1::varchar[]), true)
                            AND coalesce(access_type = any($2::varchar[]), true);
                            """
-                statement = await connection.prepare(query)
-                db_response = await statement.fetch(datasets_query, access_query)
+                db_response = await connection.fetch(query, datasets_query, access_query)
                 metadata = []
                 LOG.info(f"Showing the INFO endpoint.")
-                for record in list(db_response):
+                for record in db_response:
                     metadata.append(transform_metadata(record))
                 return metadata
             except Exception as e:
@@ -163,8 +163,10 @@ async def info_handler(request, processed_request, pool, info_endpoint=False, se
         LOG.info('Using Beacon API Specification format for Service Info.')
         beacon_info = Beacon_v1(request.host)
 
-    beacon_info.update({'datasets': beacon_dataset,
-                        'sampleAlleleRequests': sample_allele_request})
+    # The models are shared between requests, so the datasets are added to a copy
+    beacon_info = {**beacon_info,
+                   'datasets': beacon_dataset,
+                   'sampleAlleleRequests': sample_allele_request}
 
     # beacon_info = {
     #     #'id': '.'.join(reversed(host.split('.'))),
@@ -10,10 +10,10 @@ import logging
 
 from .exceptions import BeaconBadRequest, BeaconServerError, BeaconForbidden, BeaconUnauthorised
 from .. import __apiVersion__
-from ..conf.config import DB_SCHEMA
+from ..conf.config import DB_SCHEMA, DB_ACQUIRE_TIMEOUT
 
-from ..utils.polyvalent_functions import create_prepstmt_variables, filter_exists
-from ..utils.polyvalent_functions import prepare_filter_parameter, parse_filters_request
+from ..utils.polyvalent_functions import create_prepstmt_variables, filter_exists, reversed_host
+from ..utils.polyvalent_functions import prepare_filter_parameter, parse_filters_request, json_array
 from ..utils.polyvalent_functions import fetch_datasets_access, access_resolution
 
 from ..utils.polyvalent_functions import filter_response
@@ -31,14 +31,13 @@ async def transform_record(db_pool, record):
     """Format the record we got from the database to adhere to the response schema."""
 
     # Before creating the dict, we want to get the stable_id frm the DB
-    async with db_pool.acquire(timeout=180) as connection:
+    async with db_pool.acquire(timeout=DB_ACQUIRE_TIMEOUT) as connection:
         try: 
-            query = f"""SELECT stable_id, access_type
+            query = """SELECT stable_id, access_type
                         FROM beacon_dataset
-                        WHERE id={dict(record).pop("dataset_id")};
+                        WHERE id=$1;
                         """
-            statement = await connection.prepare(query)
-            extra_record = await statement.fetchrow()
+            extra_record = await connection.fetchrow(query, record["dataset_id"])
         except Exception as e:
             raise BeaconServerError(f'Query metadata (stableID) DB error: {e}') 
 
@@ -83,27 +82,25 @@ def transform_misses(record):
 async def fetch_resulting_datasets(db_pool, query_parameters, misses=False, accessible_missing=None):
     """Find datasets based on filter parameters.
     """
-    async with db_pool.acquire(timeout=180) as connection:
+    async with db_pool.acquire(timeout=DB_ACQUIRE_TIMEOUT) as connection:
         datasets = []
         try: 
             if misses:
                 if accessible_missing:
-                    query = f"""SELECT id as "datasetId", access_type as "accessType", stable_id as "stableId"
+                    query = """SELECT id as "datasetId", access_type as "accessType", stable_id as "stableId"
                                 FROM beacon_dataset
-                                WHERE id IN ({create_prepstmt_variables(len(accessible_missing))});
+                                WHERE id = any($1::int[]);
                                 """
-                    LOG.debug(f"QUERY to fetch accessible missing info: {query}")
-                    statement = await connection.prepare(query)
-                    db_response =  await statement.fetch(*accessible_missing)
+                    LOG.debug("QUERY to fetch accessible missing info: %s", query)
+                    db_response = await connection.fetch(query, accessible_missing)
                 else:
                     return []
             else:
                 query = f"""SELECT * FROM {DB_SCHEMA}.query_data_summary_response({create_prepstmt_variables(13)});"""
-                LOG.debug(f"QUERY to fetch hits: {query}")
-                statement = await connection.prepare(query)
-                db_response = await statement.fetch(*query_parameters)         
+                LOG.debug("QUERY to fetch hits: %s", query)
+                db_response = await connection.fetch(query, *query_parameters)         
 
-            for record in list(db_response):
+            for record in db_response:
                 processed = transform_misses(record) if misses else await transform_record(db_pool, record)
                 datasets.append(processed)
             return datasets
@@ -121,15 +118,15 @@ async def get_datasets(db_pool, query_parameters, include_dataset):
     dataset_ids = query_parameters[-2]
 
     hit_datasets = await fetch_resulting_datasets(db_pool, query_parameters)
-    LOG.debug(f"hit_datasets: {hit_datasets}")
+    LOG.debug("hit_datasets: %s", hit_datasets)
 
     if include_dataset in ['ALL', 'MISS']:
         list_all = list(map(int, dataset_ids.split(",")))
-        LOG.debug(f"list_all: {list_all}")
+        LOG.debug("list_all: %s", list_all)
         list_hits  =  [dict["internalId"] for dict in hit_datasets]
-        LOG.debug(f"list_hits: {list_hits}")
+        LOG.debug("list_hits: %s", list_hits)
         accessible_missing = [int(x) for x in list_all if x not in list_hits]
-        LOG.debug(f"accessible_missing: {accessible_missing}")
+        LOG.debug("accessible_missing: %s", accessible_missing)
         miss_datasets = await fetch_resulting_datasets(db_pool, query_parameters, misses=True, accessible_missing=accessible_missing)
     response = hit_datasets + miss_datasets
     return response
@@ -161,6 +158,7 @@ async def query_request_handler(db_pool, processed_request, request):
     "filters"]
     
     int_params = ['start', 'end', 'endMax', 'endMin', 'startMax', 'startMin']
+    list_params = ['datasetIds', 'filters']
 
     query_parameters = []
 
@@ -171,6 +169,8 @@ async def query_request_handler(db_pool, processed_request, request):
         if query_param:
             if param in int_params:
                 query_parameters.append(int(query_param))
+            elif param in list_params:
+                query_parameters.append(json_array(query_param))
             else:
                 query_parameters.append(str(query_param))
         else:
@@ -183,9 +183,10 @@ async def query_request_handler(db_pool, processed_request, request):
     # At this point we have a list with the needed parameters called query_parameters, the only thing 
     # laking is to update the datasetsIds (it can be "null" or processed_request.get("datasetIds"))
 
-    LOG.debug(f"Correct param: {correct_parameters}")
-    LOG.debug(f"Query param: {query_parameters}")
-    LOG.debug(f"Query param types: {[type(x) for x in query_parameters]}")
+    LOG.debug("Correct param: %s", correct_parameters)
+    LOG.debug("Query param: %s", query_parameters)
+    if LOG.isEnabledFor(logging.DEBUG):
+        LOG.debug("Query param types: %s", [type(x) for x in query_parameters])
 
     # We want to get a list of the datasets available in the database separated in three lists
     # depending on the access level (we check all of them if the user hasn't specified anything, if some
@@ -215,12 +216,12 @@ async def query_request_handler(db_pool, processed_request, request):
     else:
         include_dataset  = "ALL"
 
-    LOG.info(f"Query FINAL param: {query_parameters}")
+    LOG.info("Query FINAL param: %s", query_parameters)
     LOG.info('Connecting to the DB to make the query.')
     datasets = await get_datasets(db_pool, query_parameters, include_dataset)
     LOG.info('Query done.')
     # We create the final dictionary with all the info we want to return
-    beacon_response = { 'beaconId': '.'.join(reversed(request.host.split('.'))),
+    beacon_response = { 'beaconId': reversed_host(request.host),
                         'apiVersion': __apiVersion__,
                         'exists': any([x['exists'] for x in datasets]),
                         # Error is not required and should not be shown unless exists is null
@@ -32,7 +32,8 @@ import logging
 from aiocache import cached
 # from aiocache.serializers import JsonSerializer
 
-from .exceptions import BeaconServicesBadRequest
+from .exceptions import BeaconServicesBadRequest, BeaconServerError
+from ..conf.config import DB_ACQUIRE_TIMEOUT
 
 from ..utils.models import Beacon_v1, GA4GH_ServiceInfo_v01, organization
 
@@ -47,43 +48,41 @@ def transform_services(record, short=False):
     Transform the services record to a dict ready to be shown as a response. 
     If the short parameter is set to True, it will create a dict based on this shortened format.
     """
-    response = dict(record)
-
-    if not short: 
-        # create a dict for the organization info
-        organization = {}
-        organization['id'] = response.pop('organizaion_stable_id')
-        organization['name'] = response.pop('organization_name')
-        organization['description'] = response.pop('organization_description')
-        organization['address'] = response.pop('address')
-        organization['welcome_url'] = response.pop('organization_welcome_url')
-        organization['contact_url'] = response.pop('contact_url')
-        organization['logo_url'] = response.pop('logo_url')
-        organization['info'] = response.pop('info')
-        
-        # create the service dict
-        response["id"] = response.pop("service_stable_id")
-        response["name"] = response.pop("service_name")
-        response["serviceType"] = response.pop("service_type")
-        response["apiVersion"] = response.pop("api_version")
-        response["serviceUrl"] = response.pop("service_url")
-        response["entryPoint"] = response.pop("entry_point")
-        response["organization"] = organization
-        response["description"] = response.pop("service_description")
-        response["version"] = response.pop("version")
-        response["open"] = response.pop("open")
-        response["welcomeUrl"] = response.pop("service_welcome_url")
-        response["alternativeUrl"] = response.pop("alternative_url")
-        response["createDateTime"] = response.pop("create_date_time")
-        response["updateDateTime"] = response.pop("update_date_time")
-
-    else: 
+    if short: 
         # create the short service dict
-        response["id"] = response.pop("service_stable_id")
-        response["name"] = response.pop("service_name")
-        response["serviceUrl"] = response.pop("service_url")
-        response["serviceType"] = response.pop("service_type")
-        response["open"] = response.pop("open")
+        return {"id": record["service_stable_id"],
+                "name": record["service_name"],
+                "serviceUrl": record["service_url"],
+                "serviceType": record["service_type"],
+                "open": record["open"]}
+
+    # create a dict for the organization info
+    organization = {}
+    organization['id'] = record['organization_stable_id']
+    organization['name'] = record['organization_name']
+    organization['description'] = record['organization_description']
+    organization['address'] = record['address']
+    organization['welcome_url'] = record['organization_welcome_url']
+    organization['contact_url'] = record['contact_url']
+    organization['logo_url'] = record['logo_url']
+    organization['info'] = record['info']
+
+    # create the service dict
+    response = {}
+    response["id"] = record["service_stable_id"]
+    response["name"] = record["service_name"]
+    response["serviceType"] = record["service_type"]
+    response["apiVersion"] = record["api_version"]
+    response["serviceUrl"] = record["service_url"]
+    response["entryPoint"] = record["entry_point"]
+    response["organization"] = organization
+    response["description"] = record["service_description"]
+    response["version"] = record["version"]
+    response["open"] = record["open"]
+    response["welcomeUrl"] = record["service_welcome_url"]
+    response["alternativeUrl"] = record["alternative_url"]
+    response["createDateTime"] = record["create_date_time"]
+    response["updateDateTime"] = record["update_date_time"]
 
     return response
 
@@ -92,47 +91,47 @@ def transform_services(record, short=False):
 #                                         MAIN QUERY TO THE DATABASE
 # ----------------------------------------------------------------------------------------------------------------------
 
+# The text of both queries never changes, so each connection prepares them once and reuses them from its statement cache
+SERVICES_QUERY = """SELECT *
+                    FROM service WHERE
+                    coalesce(service_type = any($1::varchar[]), true)
+                    AND coalesce(version = any($2::varchar[]), true);"""
+
+# Returns only id, name, serviceURL, ServiceType and open
+SHORT_SERVICES_QUERY = """SELECT service_stable_id, service_name, service_url, service_type, open
+                          FROM service WHERE
+                          coalesce(service_type = any($1::varchar[]), true)
+                          AND coalesce(version = any($2::varchar[]), true);"""
+
+
+# The list of services almost never changes, so the answer is kept for 5 minutes for each combination of filters
+@cached(ttl=300, key_builder=lambda f, db_pool, processed_request: "services:{}:{}:{}".format(
+    processed_request.get('serviceType'), processed_request.get('listFormat'), processed_request.get('apiVersion')))
 async def fetch_filtered_services(db_pool, processed_request):
     """
     Fetch the services based on the filter parameters given.
+    The returned list is shared between requests through the cache, do not modify it.
     """
-    # Get the parameters
-    serviceType = None if not processed_request.get('serviceType') else processed_request.get('serviceType')
-    listFormat =  None if not processed_request.get('listFormat') else processed_request.get('listFormat')
-    version = None if not processed_request.get('apiVersion') else processed_request.get('apiVersion')
-
-    # Take one connection from the database pool
-    async with db_pool.acquire(timeout=180) as connection:
-        # Fetch different parameters depending on the listFormat
-        if not listFormat or listFormat == 'long':
-            try:
-                query = """SELECT *
-                           FROM service WHERE
-                           coalesce(service_type = any($1::varchar[]), true)
-                           AND coalesce(version = any($2::varchar[]), true);
-                           """
-                statement = await connection.prepare(query)
-                db_response = await statement.fetch(service_type, version)
-            except Exception as e:
-                raise BeaconServerError(f'Query service DB error: {e}')
-        elif listFormat == 'short': # returns only id, name, serviceURL, ServiceType and open.
-
-            try:
-                query = """SELECT service_stable_id, service_name, service_url, service_type, open
-                           FROM service WHERE
-                           coalesce(service_type = any($1::varchar[]), true)
-                           AND coalesce(version = any($2::varchar[]), true);
-                           """
-                statement = await connection.prepare(query)
-                db_response = await statement.fetch(service_type, version)
-            except Exception as e:
-                raise BeaconServerError(f'Query short service DB error: {e}')
-        services = []
-        for record in list(db_response):
-            transformed_service = transform_services(record, short=True) if listFormat == 'short' else transform_services(record)
-            services.append(transformed_service)
-        return services
-
+    # Get the parameters (the filters are compared against arrays in the query)
+    service_type = [processed_request['serviceType']] if processed_request.get('serviceType') else None
+    listFormat = None if not processed_request.get('listFormat') else processed_request.get('listFormat')
+    version = [processed_request['apiVersion']] if processed_request.get('apiVersion') else None
+
+    # Fetch different parameters depending on the listFormat
+    short = listFormat == 'short'
+    async with db_pool.acquire(timeout=DB_ACQUIRE_TIMEOUT) as connection:
+        try:
+            db_response = await connection.fetch(SHORT_SERVICES_QUERY if short else SERVICES_QUERY, service_type, version)
+        except Exception as e:
+            raise BeaconServerError(f'Query {"short " if short else ""}service DB error: {e}')
+
+    return [transform_services(record, short=short) for record in db_response]
+
+
+async def clear_services_cache():
+    """Empty the cache of fetch_filtered_services (the app calls it on SIGHUP)."""
+    LOG.info('Clearing the services cache.')
+    await fetch_filtered_services.cache.clear()
 
 
 # ----------------------------------------------------------------------------------------------------------------------
@@ -3,6 +3,7 @@
 Server was designed with async/await mindset and with at aim at performance (TBD).
 """
 
+import aiohttp
 from aiohttp import web
 import os
 import sys
@@ -10,9 +11,12 @@ import aiohttp_cors
 import logging
 import uvloop
 import asyncio
-import json
+import signal
+import orjson
+from decimal import Decimal
+from aiocache import cached
 
-from .conf.config import init_db_pool
+from .conf.config import init_db_pool, DB_ACQUIRE_TIMEOUT
 from .conf.logging import load_logger
 from .schemas import load_schema
 from .utils.validate import validate, parse_request_object, validate_services, parse_basic_request_object, validate_access_levels
@@ -24,14 +28,69 @@ from .api.filtering_terms import filtering_terms_handler
 from .api.genomic_snp import snp_request_handler
 from .api.genomic_region import region_request_handler
 from .api.access_levels import access_levels_terms_handler
-from .api.services import services_handler
+from .api.services import services_handler, clear_services_cache
 from .api.cnv import cnv_request_handler
+from .utils.polyvalent_functions import clear_annotations_cache
 
 
 
 LOG = logging.getLogger(__name__)
 routes = web.RouteTableDef()
-asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+
+
+def orjson_default(obj):
+    """Serialize the values orjson does not support natively (e.g. the Decimal of numeric columns)."""
+    if isinstance(obj, Decimal):
+        return float(obj)
+    raise TypeError
+
+
+def orjson_dumps(data):
+    """Serialize the data with orjson, non-string keys are turned into strings the same way the json module does."""
+    return orjson.dumps(data, default=orjson_default, option=orjson.OPT_NON_STR_KEYS)
+
+
+def orjson_response(data):
+    """Return a JSON response serialized with orjson, which writes the bytes of the body directly."""
+    return body_response(orjson_dumps(data))
+
+
+def body_response(body):
+    """Return a JSON response with an already serialized body."""
+    return web.Response(body=body, content_type='application/json')
+
+
+# The lists of results with more elements than this are streamed, and they are serialized in chunks of this size
+STREAMING_THRESHOLD = 500
+STREAMING_CHUNK_SIZE = 100
+
+
+async def orjson_stream_response(request, data, list_key):
+    """Return the JSON response of a query endpoint.
+    When the list of results (data[list_key]) is large, the response is sent with chunked transfer encoding:
+    the list is serialized and written in chunks so the client starts receiving it before the whole body is
+    built, and the full body is never held in memory. The bytes sent are the same as with orjson_response.
+    """
+    results = data.get(list_key)
+    if not isinstance(results, list) or len(results) <= STREAMING_THRESHOLD:
+        return orjson_response(data)
+
+    response = web.StreamResponse(headers={'Content-Type': 'application/json'})
+    await response.prepare(request)
+    separator = b'{'
+    for key, value in data.items():
+        await response.write(separator + orjson_dumps(key) + b':')
+        separator = b','
+        if key != list_key:
+            await response.write(orjson_dumps(value))
+            continue
+        for start in range(0, len(results), STREAMING_CHUNK_SIZE):
+            chunk = b','.join(orjson_dumps(result) for result in results[start:start + STREAMING_CHUNK_SIZE])
+            await response.write((b'[' if start == 0 else b',') + chunk)
+        await response.write(b']')
+    await response.write(b'}')
+    await response.write_eof()
+    return response
 
 
 # ----------------------------------------------------------------------------------------------------------------------
@@ -56,7 +115,7 @@ async def beacon_get(request):
         response = await info_handler(request, processed_request, db_pool, info_endpoint=True)
     else:
         response = await info_handler(request, processed_request, db_pool)
-    return web.json_response(response)
+    return orjson_response(response)
 
 
 # ----------------------------------------------------------------------------------------------------------------------
@@ -72,8 +131,14 @@ async def beacon_filtering_terms(request):
     """
     LOG.info('GET request to the filtering_terms endpoint.')
     db_pool = request.app['pool']
-    response = await filtering_terms_handler(request.host, db_pool)
-    return web.json_response(response)
+    return body_response(await filtering_terms_body(request.host, db_pool))
+
+
+# The filtering terms rarely change, so the serialized answer is kept for 5 minutes
+@cached(ttl=300, key_builder=lambda f, host, db_pool: f"filtering_terms:{host}")
+async def filtering_terms_body(host, db_pool):
+    """Return the serialized filtering terms response."""
+    return orjson_dumps(await filtering_terms_handler(host, db_pool))
 
 
 # ----------------------------------------------------------------------------------------------------------------------
@@ -81,195 +146,168 @@ async def beacon_filtering_terms(request):
 # ----------------------------------------------------------------------------------------------------------------------
 
 @routes.get('/access_levels')
+@routes.post('/access_levels')
 @validate_access_levels
 async def beacon_access_levels(request):
     """
-    Use the HTTP protocol 'GET' to return a Json object of the ACCESS LEVELS.
+    Use the HTTP protocol 'GET' or 'POST' to return a Json object of the ACCESS LEVELS.
 
     It uses the '/access_levels' path and only serves an information giver.
     """
-    LOG.info('GET request to the access_levels endpoint.')
+    LOG.info('%s request to the access_levels endpoint.', request.method)
     db_pool = request.app['pool']
     method, processed_request = await parse_basic_request_object(request)
-    LOG.info(f"This is the {method} processed request: {processed_request}")
-    response = await access_levels_terms_handler(db_pool, processed_request, request)
-    return web.json_response(response)
+    LOG.info("This is the %s processed request: %s", method, processed_request)
+    return body_response(await access_levels_body(db_pool, processed_request, request))
 
-@routes.post('/access_levels')
-@validate_access_levels
-async def beacon_post_access_levels(request):
-    """Find access levels using POST endpoint."""
-    LOG.info('POST request to the access_levels endpoint.')
-    db_pool = request.app['pool']
-    method, processed_request = await parse_basic_request_object(request)
-    LOG.info(f"This is the {method} processed request: {processed_request}")
-    response = await access_levels_terms_handler(db_pool, processed_request, request)
-    return web.json_response(response)
+
+# The access levels rarely change, so the serialized answer is kept for 5 minutes for each host and combination of parameters
+@cached(ttl=300, key_builder=lambda f, db_pool, processed_request, request: "access_levels:{}:{}".format(
+    request.host, sorted(processed_request.items())))
+async def access_levels_body(db_pool, processed_request, request):
+    """Return the serialized access levels response."""
+    return orjson_dumps(await access_levels_terms_handler(db_pool, processed_request, request))
 
 
 # ----------------------------------------------------------------------------------------------------------------------
 #                                         SERVICES ENDPOINT OPERATIONS
 # ----------------------------------------------------------------------------------------------------------------------
 @routes.get('/services')
-@validate_services
-async def beacon_get(request):
-    """
-    Use the HTTP protocol 'GET' to return a Json object of all the necessary info of the SERVICES.
-
-    It uses the '/services' path and only serves an information giver.
-    """
-    LOG.info('GET request to the services endpoint.')
-    db_pool = request.app['pool']
-    method, processed_request = await parse_basic_request_object(request)
-    LOG.info(f"This is the {method} processed request: {processed_request}")
-    response = await services_handler(db_pool, processed_request, request)
-
-    return web.json_response(response)
-
 @routes.post('/services')
 @validate_services
-async def beacon_get(request):
+async def beacon_services(request):
     """
-    Use the HTTP protocol 'GET' to return a Json object of all the necessary info of the SERVICES.
+    Use the HTTP protocol 'GET' or 'POST' to return a Json object of all the necessary info of the SERVICES.
 
     It uses the '/services' path and only serves an information giver.
     """
-    LOG.info('POST request to the services endpoint.')
+    LOG.info('%s request to the services endpoint.', request.method)
     db_pool = request.app['pool']
     method, processed_request = await parse_basic_request_object(request)
-    LOG.info(f"This is the {method} processed request: {processed_request}")
+    LOG.info("This is the %s processed request: %s", method, processed_request)
     response = await services_handler(db_pool, processed_request, request)
 
-    return web.json_response(response)
+    return orjson_response(response)
 
 
 # ----------------------------------------------------------------------------------------------------------------------
 #                                         QUERY ENDPOINT OPERATIONS
 # ----------------------------------------------------------------------------------------------------------------------
-# These could be put under a @route.view('/query')
+# The same handler serves both methods, the validation and the parsing depend on request.method
 
 @routes.get('/query')
-@validate("query")
-async def beacon_get_query(request):
-    db_pool = request.app['pool']
-    method, processed_request = await parse_request_object(request)
-    LOG.info(f"This is the {method} processed request: {processed_request}")
-    query_response = await query_request_handler(db_pool, processed_request, request)
-    return web.json_response(query_response, content_type='application/json', dumps=json.dumps)
-
-
-
 @routes.post('/query')
 @validate("query")
-async def beacon_post_query(request):
-    """Find datasets using POST endpoint."""
+async def beacon_query(request):
+    """Find datasets using the GET or POST endpoint."""
     db_pool = request.app['pool']
     method, processed_request = await parse_request_object(request)
-    LOG.info(f"This is the {method} processed request: {processed_request}")
+    LOG.info("This is the %s processed request: %s", method, processed_request)
     query_response = await query_request_handler(db_pool, processed_request, request)
-    return web.json_response(query_response, content_type='application/json', dumps=json.dumps)
+    return await orjson_stream_response(request, query_response, 'datasetAlleleResponses')
 
 
 # ----------------------------------------------------------------------------------------------------------------------
 #                                         GENOMIC_SNP ENDPOINT OPERATIONS
 # ----------------------------------------------------------------------------------------------------------------------
-# These could be put under a @route.view('/query')
-
 @routes.get('/genomic_snp')
-@validate("genomic_snp")
-async def beacon_get_snp(request):
-    db_pool = request.app['pool']
-    method, processed_request = await parse_request_object(request)
-    LOG.info(f"This is the {method} processed request: {processed_request}")
-    query_response = await snp_request_handler(db_pool, processed_request, request)
-    return web.json_response(query_response, content_type='application/json', dumps=json.dumps)
-
-
-
 @routes.post('/genomic_snp')
 @validate("genomic_snp")
-async def beacon_post_snp(request):
-    """Find datasets using POST endpoint."""
+async def beacon_snp(request):
+    """Find datasets using the GET or POST endpoint."""
     db_pool = request.app['pool']
     method, processed_request = await parse_request_object(request)
-    LOG.info(f"This is the {method} processed request: {processed_request}")
+    LOG.info("This is the %s processed request: %s", method, processed_request)
     query_response = await snp_request_handler(db_pool, processed_request, request)
-    return web.json_response(query_response, content_type='application/json', dumps=json.dumps)
+    return await orjson_stream_response(request, query_response, 'datasetAlleleResponses')
 
 
 # ----------------------------------------------------------------------------------------------------------------------
 #                                         GENOMIC_REGION ENDPOINT OPERATIONS
 # ----------------------------------------------------------------------------------------------------------------------
-# These could be put under a @route.view('/query')
-
 @routes.get('/genomic_region')
-@validate("genomic_region")
-async def beacon_get_region(request):
-    db_pool = request.app['pool']
-    method, processed_request = await parse_request_object(request)
-    LOG.info(f"This is the {method} processed request: {processed_request}")
-    query_response = await region_request_handler(db_pool, processed_request, request)
-    return web.json_response(query_response, content_type='application/json', dumps=json.dumps)
-
-
-
 @routes.post('/genomic_region')
 @validate("genomic_region")
-async def beacon_post_region(request):
-    """Find datasets using POST endpoint."""
+async def beacon_region(request):
+    """Find datasets using the GET or POST endpoint."""
     db_pool = request.app['pool']
     method, processed_request = await parse_request_object(request)
-    LOG.info(f"This is the {method} processed request: {processed_request}")
+    LOG.info("This is the %s processed request: %s", method, processed_request)
     query_response = await region_request_handler(db_pool, processed_request, request)
-    return web.json_response(query_response, content_type='application/json', dumps=json.dumps)
+    return await orjson_stream_response(request, query_response, 'variantsFound')
+
 
 # ----------------------------------------------------------------------------------------------------------------------
 #                                         CNV ENDPOINT OPERATIONS
 # ----------------------------------------------------------------------------------------------------------------------
-# These could be put under a @route.view('/query')
-
 @routes.get('/cnv')
-@validate("cnv")
-async def beacon_get_cnv(request):
-    db_pool = request.app['pool']
-    method, processed_request = await parse_request_object(request)
-    LOG.info(f"This is the {method} processed request: {processed_request}")
-    query_response = await cnv_request_handler(db_pool, processed_request, request)
-    return web.json_response(query_response, content_type='application/json', dumps=json.dumps)
-
-
-
 @routes.post('/cnv')
 @validate("cnv")
-async def beacon_post_cnv(request):
-    """Find datasets using POST endpoint."""
+async def beacon_cnv(request):
+    """Find datasets using the GET or POST endpoint."""
     db_pool = request.app['pool']
     method, processed_request = await parse_request_object(request)
-    LOG.info(f"This is the {method} processed request: {processed_request}")
+    LOG.info("This is the %s processed request: %s", method, processed_request)
     query_response = await cnv_request_handler(db_pool, processed_request, request)
-    return web.json_response(query_response, content_type='application/json', dumps=json.dumps)
+    return await orjson_stream_response(request, query_response, 'variantsFound')
+
 
 # ----------------------------------------------------------------------------------------------------------------------
 #                                         SETUP FUNCTIONS
 # ----------------------------------------------------------------------------------------------------------------------
 
+async def clear_caches():
+    """Empty the in-memory caches of the external annotations, the services, the filtering terms and the access levels."""
+    await asyncio.gather(clear_annotations_cache(),
+                         clear_services_cache(),
+                         filtering_terms_body.cache.clear(),
+                         access_levels_body.cache.clear())
+
+
+# The running clear_caches tasks, referenced here so they are not garbage collected before they finish
+clear_caches_tasks = set()
+
+
+def clear_caches_done(task):
+    """Forget a finished clear_caches task and log its error, if any."""
+    clear_caches_tasks.discard(task)
+    if not task.cancelled() and task.exception():
+        LOG.error('Clearing the caches failed: %s', task.exception())
+
+
+def schedule_clear_caches():
+    """Start clear_caches in the background (the SIGHUP handler cannot await it)."""
+    task = asyncio.ensure_future(clear_caches())
+    clear_caches_tasks.add(task)
+    task.add_done_callback(clear_caches_done)
+
+
 async def initialize(app):
     """Spin up DB a connection pool with the HTTP server."""
+    LOG.debug('Running on the %s event loop.', type(asyncio.get_running_loop()).__module__)
     LOG.debug('Create PostgreSQL connection pool.')
     app['pool'] = await init_db_pool()
     LOG.debug("Testing the DB connection.")
     db_pool = app['pool']
-    async with db_pool.acquire(timeout=180) as connection:
+    async with db_pool.acquire(timeout=DB_ACQUIRE_TIMEOUT) as connection:
         query = """SELECT 1;
                     """
-        statement = await connection.prepare(query)
-        db_response =  await statement.fetch()
+        db_response = await connection.fetch(query)
+    # One HTTP client session shared by all the requests to the external annotation APIs (cellBase, dbSNP),
+    # its connections are kept alive and reused, and the DNS answers cached, so most calls cost a single round-trip
+    LOG.debug('Create HTTP client session.')
+    connector = aiohttp.TCPConnector(limit=100, limit_per_host=20, ttl_dns_cache=600, keepalive_timeout=60)
+    app['http_session'] = aiohttp.ClientSession(connector=connector, timeout=aiohttp.ClientTimeout(total=10),
+                                                json_serialize=lambda obj: orjson.dumps(obj).decode())
+    # Several answers are cached in memory (see clear_caches), sending a SIGHUP to the server empties the caches
+    asyncio.get_running_loop().add_signal_handler(signal.SIGHUP, schedule_clear_caches)
     set_cors(app)
 
 
 async def destroy(app):
-    """Upon server close, close the DB connection pool."""
+    """Upon server close, close the DB connection pool and the HTTP client session."""
     await app['pool'].close()
+    await app['http_session'].close()
 
 
 def set_cors(server):
@@ -303,19 +341,26 @@ def main():
 
     At start also initialize a PostgreSQL connection pool.
     """
+    # The C HTTP parser of aiohttp is used unless its extensions were not built (or AIOHTTP_NO_EXTENSIONS is set)
+    try:
+        from aiohttp.http_parser import HttpRequestParserC  # noqa: F401
+        LOG.info('Using the C HTTP parser of aiohttp.')
+    except ImportError:
+        LOG.warning('The C HTTP parser of aiohttp is not available, using the pure-Python one.')
     # TO DO make it HTTPS and request certificate
     # sslcontext.load_cert_chain(ssl_certfile, ssl_keyfile)
     # sslcontext = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
     # sslcontext.check_hostname = False
+    # The server runs on a uvloop loop
     web.run_app(init(), host=os.environ.get('HOST', '0.0.0.0'),
                 port=os.environ.get('PORT', '5050'),
-                shutdown_timeout=0, ssl_context=None)
+                shutdown_timeout=0, ssl_context=None, loop=uvloop.new_event_loop())
 
 
 
 
 if __name__ == '__main__':
-    if sys.version_info < (3, 6):
-        LOG.error("beacon-python requires python3.6")
+    if sys.version_info < (3, 8):
+        LOG.error("beacon-python requires python3.8")
         sys.exit(1)
     main()
@@ -9,6 +9,8 @@ We use:
 * ``DATABASE_PASSWORD`` - PostgreSQL user associated password
 * ``DATABASE_NAME`` - PostgreSQL database name/view utilised by the ``elixir_beacon_dev``
 * ``DATABASE_SCHEMA`` - in case a schema is used
+* ``DATABASE_POOL_MIN_SIZE`` / ``DATABASE_POOL_MAX_SIZE`` - number of connections kept in the pool
+* ``DATABASE_ACQUIRE_TIMEOUT`` - seconds a request waits for a free connection of the pool
 
 The variable is then used to configure the application to connect to that database using asyncpg.
 At this point we also initialize a connection pool that the API is going to use on all its endpoints.
@@ -16,8 +18,29 @@ At this point we also initialize a connection pool that the API is going to use
 
 import os
 import asyncpg
+import orjson
 
 DB_SCHEMA = os.environ.get('DATABASE_SCHEMA', 'public')
+DB_POOL_MIN_SIZE = int(os.environ.get('DATABASE_POOL_MIN_SIZE', 10))
+DB_POOL_MAX_SIZE = int(os.environ.get('DATABASE_POOL_MAX_SIZE', 20))
+# When every connection is busy it is better to answer with an error soon than to pile up waiting requests
+DB_ACQUIRE_TIMEOUT = int(os.environ.get('DATABASE_ACQUIRE_TIMEOUT', 10))
+
+def _orjson_encoder(value):
+    """Serialize a value for a json/jsonb parameter (the text codec expects a str)."""
+    return orjson.dumps(value).decode()
+
+
+async def init_db_connection(connection):
+    """Register the codecs of each new connection of the pool.
+
+    The json and jsonb columns (e.g. ``extra_info``) are decoded with orjson, so the records already
+    hold the parsed values instead of the raw JSON text.
+    """
+    for json_type in ('json', 'jsonb'):
+        await connection.set_type_codec(json_type, encoder=_orjson_encoder, decoder=orjson.loads,
+                                        schema='pg_catalog', format='text')
+
 
 async def init_db_pool():
     """Create a connection pool.
@@ -32,13 +55,16 @@ async def init_db_pool():
                                      # Multiple schemas can be used, and they need to be comma separated
                                      # server_settings={'search_path': DB_SCHEMA if DB_SCHEMA else 'public'},
                                      server_settings={'search_path': DB_SCHEMA},
-                                     # initializing with 0 connections allows the web server to
-                                     # start and also continue to live
-                                     min_size=0,
-                                     # for now limiting the number of connections in the pool
-                                     max_size=20,
+                                     # the connections are opened at startup so the first requests don't pay for them
+                                     # (setting the same min and max size keeps the pool fully preallocated)
+                                     min_size=DB_POOL_MIN_SIZE,
+                                     max_size=DB_POOL_MAX_SIZE,
                                      max_queries=50000,
                                      timeout=120,
                                      command_timeout=180,
+                                     # the queries of the endpoints are fixed texts with bound parameters, each connection
+                                     # prepares them once and keeps them (0 means the cached statements never expire)
+                                     statement_cache_size=1024,
                                      max_cached_statement_lifetime=0,
-                                     max_inactive_connection_lifetime=180)
+                                     max_inactive_connection_lifetime=300,
+                                     init=init_db_connection)
@@ -1,4 +1,7 @@
+from functools import lru_cache
 
+
+from .polyvalent_functions import reversed_host
 from .. import __id__, __beacon_name__, __apiVersion__, __org_id__, __org_name__, __org_description__, __org_adress__, __org_welcomeUrl__, __org_contactUrl__, __org_logoUrl__, __org_info__
 from .. import __description__, __version__, __welcomeUrl__, __alternativeUrl__, __createDateTime__, __updateDateTime__
 from .. import __service__, __serviceUrl__, __entryPoint__, __open__, __service_type__, __documentationUrl__, __environment__
@@ -15,9 +18,13 @@ organization = {
     'info': __org_info__,
 }
 
+@lru_cache(maxsize=32)
 def Beacon_v1(host):
+    """Return the Beacon-v1 model of this beacon for the given host.
+    The same dict is returned for every call with a given host, do not modify it.
+    """
     Beacon_v1 = {
-        'id': '.'.join(reversed(host.split('.'))),
+        'id': reversed_host(host),
         'name': __beacon_name__,
         'serviceType': __service__,
         'apiVersion': __apiVersion__,
@@ -34,9 +41,13 @@ def Beacon_v1(host):
     }
     return Beacon_v1
 
+@lru_cache(maxsize=32)
 def GA4GH_ServiceInfo_v01(host):
+    """Return the GA4GH-ServiceInfo-v0.1 model of this beacon for the given host.
+    The same dict is returned for every call with a given host, do not modify it.
+    """
     GA4GH_ServiceInfo_v01 = {
-        'id': '.'.join(reversed(host.split('.'))),
+        'id': reversed_host(host),
         'name': __beacon_name__,
         'type': __service_type__,
         'description': __description__,
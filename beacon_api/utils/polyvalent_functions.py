@@ -4,14 +4,23 @@
  - To manage access resolution
 """
 
-import ast
+import asyncio
 import logging
+import os
+import orjson
+from functools import lru_cache
 import yaml
 from pathlib import Path
+try:
+    from yaml import CSafeLoader as SafeLoader  # libyaml bindings, when PyYAML was built with them
+except ImportError:
+    from yaml import SafeLoader
+from aiocache import cached_stampede, SimpleMemoryCache
+from async_lru import alru_cache
 
 from ..api.exceptions import BeaconBadRequest, BeaconServerError, BeaconForbidden, BeaconUnauthorised
 from .. import __apiVersion__
-from ..conf.config import DB_SCHEMA
+from ..conf.config import DB_SCHEMA, DB_ACQUIRE_TIMEOUT
 
 LOG = logging.getLogger(__name__)
 
@@ -32,6 +41,103 @@ def create_prepstmt_variables(value):
 
 
 
+async def fetch_json(http_session, url):
+    """Fetch an external API with the shared aiohttp session and return its JSON body.
+    A non-2xx answer (e.g. a 429 rate limit reply) raises aiohttp.ClientResponseError, so it is never cached as an annotation.
+    """
+    async with http_session.get(url) as r:
+        r.raise_for_status()
+        body = await r.read()
+    return orjson.loads(body) if body.strip() else None
+
+
+# The annotations of a variant rarely change, so the answers of both APIs are kept in a bounded LRU cache
+# for a day (the common SNPs are then served without any network traffic)
+ANNOTATIONS_CACHE_TTL = 24 * 60 * 60
+
+# Maximum number of variants whose annotations are being fetched at the same time in a request
+ANNOTATIONS_CONCURRENCY = 20
+
+
+@alru_cache(maxsize=4096, ttl=ANNOTATIONS_CACHE_TTL)
+async def fetch_cellbase(http_session, variant_id):
+    """Fetch the cellBase annotation of a variant given as chrom:start:ref:alt."""
+    url = f"http://cellbase.clinbioinfosspa.es/cb/webservices/rest/v4/hsapiens/genomic/variant/{variant_id}/annotation"
+    return await fetch_json(http_session, url)
+
+
+@alru_cache(maxsize=4096, ttl=ANNOTATIONS_CACHE_TTL)
+async def fetch_dbsnp(http_session, rsID):
+    """Fetch the dbSNP information of a variant given its rsID."""
+    url = f"https://api.ncbi.nlm.nih.gov/variation/v0/beta/refsnp/{rsID[2:]}"
+    return await fetch_json(http_session, url)
+
+
+# NCBI E-utilities accept many ids per esummary request, so the dbSNP summaries of a whole region
+# are fetched in a few requests instead of one per variant
+ESUMMARY_BATCH_SIZE = 200
+# With an API key NCBI allows 10 requests per second instead of 3
+NCBI_API_KEY = os.environ.get('NCBI_API_KEY')
+
+# The summaries are kept per rsID for as long as the other annotations, so a batch only asks for the
+# rsIDs that are not cached yet
+DBSNP_SUMMARIES_CACHE = SimpleMemoryCache()
+
+
+async def fetch_dbsnp_summaries(http_session, rsIDs, semaphore):
+    """Fetch the dbSNP esummary of several variants given their rsIDs, in batches of ESUMMARY_BATCH_SIZE.
+    The batches run through the given semaphore, the one that limits the other annotation requests.
+    Return a dict with the rsID as key and its summary as value (the rsIDs that are not found are missing).
+    If a batch fails its error is raised, once the summaries of the successful batches are cached.
+    """
+    rsIDs = sorted(set(rsIDs))
+    if not rsIDs:
+        return {}
+    cached_summaries = await DBSNP_SUMMARIES_CACHE.multi_get(rsIDs)
+    summaries = {rsID: summary for rsID, summary in zip(rsIDs, cached_summaries) if summary is not None}
+
+    uids = [rsID[2:] for rsID in rsIDs if rsID not in summaries]
+    batches = [uids[i:i + ESUMMARY_BATCH_SIZE] for i in range(0, len(uids), ESUMMARY_BATCH_SIZE)]
+    api_key = f"&api_key={NCBI_API_KEY}" if NCBI_API_KEY else ""
+    urls = [f"https://eutils.ncbi.nlm.nih.gov/entrez/eutils/esummary.fcgi?db=snp&retmode=json&id={','.join(batch)}{api_key}"
+            for batch in batches]
+
+    async def fetch_batch(url):
+        async with semaphore:
+            return await fetch_json(http_session, url)
+
+    fetched_summaries = {}
+    errors = []
+    for esummary in await asyncio.gather(*[fetch_batch(url) for url in urls], return_exceptions=True):
+        if isinstance(esummary, Exception):
+            errors.append(esummary)
+            continue
+        result = (esummary or {}).get("result", {})
+        for uid in result.get("uids", []):
+            fetched_summaries[f"rs{uid}"] = result[uid]
+    if fetched_summaries:
+        await DBSNP_SUMMARIES_CACHE.multi_set(list(fetched_summaries.items()), ttl=ANNOTATIONS_CACHE_TTL)
+    if errors:
+        raise errors[0]
+
+    summaries.update(fetched_summaries)
+    return summaries
+
+
+async def clear_annotations_cache():
+    """Empty the cellBase and dbSNP caches (the app calls it on SIGHUP)."""
+    LOG.info('Clearing the variant annotations cache.')
+    fetch_cellbase.cache_clear()
+    fetch_dbsnp.cache_clear()
+    await DBSNP_SUMMARIES_CACHE.clear()
+
+
+@lru_cache(maxsize=32)
+def reversed_host(host):
+    """Return the beaconId of a host, its domain parts in reverse order (e.g. 'org.example.beacon')."""
+    return '.'.join(reversed(host.split('.')))
+
+
 def filter_exists(include_dataset, datasets):
     """Return those datasets responses that the `includeDatasetResponses` parameter decides.
     Look at the exist parameter in each returned dataset to established HIT or MISS.
@@ -46,8 +152,11 @@ def filter_exists(include_dataset, datasets):
         return [d for d in datasets if d['exists'] is False]
 
 
+@lru_cache(maxsize=1024)
 def datasetHandover(dataset_name):
-    """Return the datasetHandover with the correct name of the dataset."""
+    """Return the datasetHandover with the correct name of the dataset.
+    The same list is returned for every call with a given name, do not modify it.
+    """
     datasetHandover = [ { "handoverType" : {
                                         "id" : "CUSTOM",
                                         "label" : "Dataset info"
@@ -62,27 +171,60 @@ def datasetHandover(dataset_name):
 #                                         YAML LOADER
 # ----------------------------------------------------------------------------------------------------------------------
 
+@lru_cache(maxsize=8)
 def find_yml_and_load(input_file):
-    """Try to load the access levels yaml and return it as a dict."""
+    """Try to load the access levels yaml and return it as a dict.
+    The file is read only once, the same dict is returned for every call with a given file, do not modify it.
+    """
     file = Path(input_file)
 
     if not file.exists():
-        LOG.error(f"The file '{file}' does not exist", file=sys.stderr)
+        LOG.error(f"The file '{file}' does not exist")
         return
 
     if file.suffix in ('.yaml', '.yml'):
         with open(file, 'r') as stream:
-            file_dict = yaml.safe_load(stream)
+            file_dict = yaml.load(stream, Loader=SafeLoader)
             return file_dict
 
     # Otherwise, fail
-    LOG.error(f"Unsupported format for {file}", file=sys.stderr)
+    LOG.error(f"Unsupported format for {file}")
 
 
 # ----------------------------------------------------------------------------------------------------------------------
 #                                         FILTERING TERMS MANAGEMENT
 # ----------------------------------------------------------------------------------------------------------------------
 
+def json_array(values):
+    """Serialize a list given in the request (datasetIds, filters) to the JSON array string that
+    is passed to fetch_datasets_access and prepare_filter_parameter.
+    """
+    return orjson.dumps(values).decode()
+
+
+# Parameters of the SQL functions of the genomic region and CNV endpoints, in order, with the type they are
+# converted to and the value used when they are missing
+QUERY_PARAMETERS_SPEC = (
+    ("variantType", str, "null"),
+    ("start", int, None),
+    ("startMin", int, None),
+    ("startMax", int, None),
+    ("end", int, None),
+    ("endMin", int, None),
+    ("endMax", int, None),
+    ("referenceName", str, "null"),
+    ("referenceBases", str, "null"),
+    ("alternateBases", str, "null"),
+    ("assemblyId", str, "null"),
+    ("datasetIds", json_array, "null"),
+    ("filters", json_array, "null"),
+)
+
+
+# The two-character operators go first so they are not taken as "=", ">" or "<"
+FILTER_OPERATORS = (">=", "<=", "=", ">", "<")
+
+
 def parse_filters_request(filters_request_list):
     """Create a list of the filters passed in the query, where each filter
     is another list in the main list with the following elements: ontology, term, operator, value.
@@ -90,27 +232,30 @@ def parse_filters_request(filters_request_list):
     list_filters = []
     for unprocessed_filter in filters_request_list:
         filter_elements = unprocessed_filter.split(":")
-        ontology = filter_elements[0]
-        operator_switch = False
-        for operator in [">=", "<=", "=",  ">", "<"]:  # TO DO: raise an error if "=<" or "=>" are given
-            if operator in filter_elements[1]:
-                operator = operator
-                term = filter_elements[1].split(operator)[0]
-                value = filter_elements[1].split(operator)[1]
-                operator_switch = True
-                break
-
-        if operator_switch:
-            final_elements = [ontology, term,  operator, value]
-            operator_switch = False
+        ontology, term = filter_elements[0], filter_elements[1]
+        # TO DO: raise an error if "=<" or "=>" are given
+        operator = next((operator for operator in FILTER_OPERATORS if operator in term), None)
+        if operator:
+            term, value = term.split(operator)[:2]
+            list_filters.append([ontology, term, operator, value])
         else:
-            final_elements = [ontology, filter_elements[1]]
-
-        list_filters.append(final_elements)
+            list_filters.append([ontology, term])
 
     return list_filters
 
 
+# The ontology:term combinations are bound as an array, so the text of the query never changes
+# and each connection reuses its cached prepared statement
+FILTER_COLUMNS_QUERY = """SELECT column_name, column_value
+                          FROM ontology_term_column_correspondance
+                          WHERE concat_ws(':', ontology, term) = any($1::text[]);"""
+
+
+def quote_literal(value):
+    """Quote a value as an SQL string literal, doubling its single quotes."""
+    return "'" + str(value).replace("'", "''") + "'"
+
+
 async def prepare_filter_parameter(db_pool, filters_request):
     """Parse the filters parameters given in the query to create the string that needs to be passed
     to the SQL query.
@@ -119,46 +264,25 @@ async def prepare_filter_parameter(db_pool, filters_request):
     """
 
     # First we want to parse the filters request
-    list_filters = parse_filters_request(ast.literal_eval(filters_request))
+    list_filters = parse_filters_request(orjson.loads(filters_request))
     
-    combinations_list = "','".join([":".join([filter_elements[0],filter_elements[1]]) for filter_elements in list_filters])
-    combinations_list =  "'" + combinations_list + "'"
+    combinations_list = [f"{filter_elements[0]}:{filter_elements[1]}" for filter_elements in list_filters]
 
-    # Then we connect to the DB and retrieve the parameters that will be passed to the main query
-    async with db_pool.acquire(timeout=180) as connection:
-        response = []
+    # Then we retrieve the parameters that will be passed to the main query
+    async with db_pool.acquire(timeout=DB_ACQUIRE_TIMEOUT) as connection:
         try: 
-            query  = f"""SELECT column_name, column_value 
-                        FROM ontology_term_column_correspondance
-                        WHERE concat_ws(':', ontology, term) IN ({combinations_list})"""
-
-            LOG.debug(f"QUERY filters info: {query}")
-            statement = await connection.prepare(query)
-            db_response = await statement.fetch()
-            column_name_dict = {}
-            for record in list(db_response):
-                if record['column_name'] not in column_name_dict.keys():
-                # prepare the dict
-                    column_name_dict[record['column_name']] = []
-                    column_name_dict[record['column_name']].append(record['column_value'])
-                else:
-                    # fill it
-                    column_name_dict[record['column_name']].append(record['column_value'])
-
-            # After we have retrieved the values in a dict with the column_name as keys, we need to create the final string
-            strings_list = []
-            final_string = ""
-            for column_name, values in column_name_dict.items():
-                string_values = ", ".join("'" + str(value) + "'" for value in values)
-                string = f'({column_name})::jsonb ?& array[{string_values}]'
-                strings_list.append(string)
-
-            # Once we have the response, we parse it to create the final string needed as input
-            final_string = " AND ".join(strings_list)
-            return str(final_string)
-
+            LOG.debug("QUERY filters info: %s", FILTER_COLUMNS_QUERY)
+            db_response = await connection.fetch(FILTER_COLUMNS_QUERY, combinations_list)
         except Exception as e:
-               raise BeaconServerError(f'Query filters DB error: {e}') 
+            raise BeaconServerError(f'Query filters DB error: {e}')
+    column_name_dict = {}
+    for record in db_response:
+        column_name_dict.setdefault(record['column_name'], []).append(record['column_value'])
+
+    # After we have retrieved the values in a dict with the column_name as keys, we create the final string
+    # (it ends up inside the text of the main query, so the values are quoted as SQL literals)
+    return " AND ".join(f'({column_name})::jsonb ?& array[{", ".join(map(quote_literal, values))}]'
+                        for column_name, values in column_name_dict.items())
 
 
 # ----------------------------------------------------------------------------------------------------------------------
@@ -208,36 +332,55 @@ def access_resolution(request, token, host, public_data, registered_data, contro
             raise BeaconUnauthorised(request, host, "missing_token", 'Unauthorized access to dataset(s), missing token.')
         # token is present, but is missing perms (user authed but no access)
         raise BeaconForbidden(request, host, 'Access to dataset(s) is forbidden.')
-    LOG.info(f"Accesible datasets are: {list(access)}.")
+    LOG.info("Accesible datasets are: %s.", list(access))
     return permissions, list(access)
 
 
+# The ids are split by access type in the DB, so a single row with the three lists is returned
+# (coalesce turns the aggregate of no rows into an empty list)
+DATASETS_ACCESS_QUERY = """SELECT coalesce(array_agg(id) FILTER (WHERE access_type = 'PUBLIC'), '{}') AS public,
+                                  coalesce(array_agg(id) FILTER (WHERE access_type = 'REGISTERED'), '{}') AS registered,
+                                  coalesce(array_agg(id) FILTER (WHERE access_type = 'CONTROLLED'), '{}') AS controlled
+                           FROM public.beacon_dataset
+                           WHERE coalesce(stable_id = any($1), true);"""
+
+
+# The available datasets rarely change, so the answer is kept for 60 seconds for each requested datasetIds value
+# (the stampede lock makes concurrent misses for the same key wait for a single DB round-trip)
+@cached_stampede(lease=2, ttl=60, key_builder=lambda f, db_pool, datasets: f"datasets_access:{datasets}")
 async def fetch_datasets_access(db_pool, datasets):
-    """Retrieve 3 list of the available datasets depending on the access type"""
+    """Retrieve 3 list of the available datasets depending on the access type.
+    The returned lists are shared between requests through the cache, do not modify them.
+    """
     LOG.info('Retrieving info about the available datasets (id and access type).')
-    public = []
-    registered = []
-    controlled = []
-    async with db_pool.acquire(timeout=180) as connection:
-        async with connection.transaction():
-            datasets_query = None if datasets == "null" else ",".join(ast.literal_eval(datasets))
-            try:
-                query = """SELECT access_type, id, stable_id FROM public.beacon_dataset
-                           WHERE coalesce(stable_id = any($1), true);
-                           """
-                LOG.debug(f"QUERY datasets access: {query}")
-                statement = await connection.prepare(query)
-                db_response = await statement.fetch(datasets_query)
-                for record in list(db_response):
-                    if record['access_type'] == 'PUBLIC':
-                        public.append(record['id'])
-                    if record['access_type'] == 'REGISTERED':
-                        registered.append(record['id'])
-                    if record['access_type'] == 'CONTROLLED':
-                        controlled.append(record['id'])
-                return public, registered, controlled
-            except Exception as e:
-                raise BeaconServerError(f'Query available datasets DB error: {e}')
+    datasets_query = None if datasets == "null" else orjson.loads(datasets)
+    async with db_pool.acquire(timeout=DB_ACQUIRE_TIMEOUT) as connection:
+        try:
+            LOG.debug("QUERY datasets access: %s", DATASETS_ACCESS_QUERY)
+            public, registered, controlled = await connection.fetchrow(DATASETS_ACCESS_QUERY, datasets_query)
+        except Exception as e:
+            raise BeaconServerError(f'Query available datasets DB error: {e}')
+    return public, registered, controlled
+
+
+DATASETS_METADATA_QUERY = """SELECT id, stable_id, access_type
+                             FROM beacon_dataset
+                             WHERE id = any($1::int[]);
+                             """
+
+
+async def fetch_datasets_metadata(connection, dataset_ids):
+    """Fetch the stable_id and access_type of the given datasets in a single query.
+    Return a dict with the dataset id as key and its record as value.
+    """
+    if not dataset_ids:
+        return {}
+    try: 
+        # connection.fetch (unlike connection.prepare) goes through the statement cache of the connection
+        db_response = await connection.fetch(DATASETS_METADATA_QUERY, list(dataset_ids))
+    except Exception as e:
+        raise BeaconServerError(f'Query metadata (stableID) DB error: {e}') 
+    return {record["id"]: record for record in db_response}
 
 # ----------------------------------------------------------------------------------------------------------------------
 #                                    FILTER RESPONSE BASED ON ACCESS LEVELS
@@ -255,28 +398,24 @@ def filter_response(response, access_levels_dict, accessible_datasets, user_leve
     :param parent_key: used inside de recursion to store the parent key of the dict we are in
     :return:
     """
-    final_dict = {}
     if isinstance(response, dict):
+        final_dict = {}
+        # The access levels of the fields found at this level of the response
+        specific_access_levels_dict = access_levels_dict[parent_key] if parent_key else access_levels_dict
         for key, val in response.items():
-            translated_key = field2access[key] if key in field2access.keys() else key
-            specific_access_levels_dict = access_levels_dict[parent_key] if parent_key else access_levels_dict
-            if translated_key not in access_levels_dict.keys() and translated_key not in specific_access_levels_dict.keys():
+            translated_key = field2access.get(key, key)
+            if translated_key not in access_levels_dict and translated_key not in specific_access_levels_dict:
                 final_dict[key] = val
-            else:
-                # if (isinstance(val, dict) or isinstance(val, list)) and key != "info":
-                if (isinstance(val, dict) or isinstance(val, list)) and translated_key in access_levels_dict.keys():
-                    parent_permission = True
-                    self_permission = True if access_levels_dict[translated_key]["accessLevelSummary"] in user_levels else False
-                    if parent_key:
-                        parent_permission = True if access_levels_dict[parent_key][key] in user_levels else False
-                    if self_permission and parent_permission:
-                        final_dict[key] = filter_response(val, access_levels_dict, accessible_datasets, user_levels, field2access, translated_key)
-                else:
-                    valid_level = access_levels_dict[parent_key][translated_key] if parent_key else access_levels_dict[translated_key]
-                    if valid_level in user_levels:
-                        final_dict[key] = val
-
-    elif isinstance(response, list):
+            elif isinstance(val, (dict, list)) and translated_key in access_levels_dict:
+                self_permission = access_levels_dict[translated_key]["accessLevelSummary"] in user_levels
+                parent_permission = specific_access_levels_dict[key] in user_levels if parent_key else True
+                if self_permission and parent_permission:
+                    final_dict[key] = filter_response(val, access_levels_dict, accessible_datasets, user_levels, field2access, translated_key)
+            elif specific_access_levels_dict[translated_key] in user_levels:
+                final_dict[key] = val
+        return final_dict
+
+    if isinstance(response, list):
         filtered = []
         for element in response:
             if isinstance(element, dict):
@@ -285,5 +424,5 @@ def filter_response(response, access_levels_dict, accessible_datasets, user_leve
                     filtered.append(filter_response(element, access_levels_dict, accessible_datasets, user_levels, field2access, parent_key))
         return filtered
 
-    return final_dict
+    return {}
 
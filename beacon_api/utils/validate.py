@@ -1,7 +1,7 @@
 """JSON Request/Response Validation and Token authentication (not implemented yet).
 """
 
-import json
+import orjson
 import re
 import os
 import logging
@@ -35,7 +35,7 @@ async def parse_request_object(request):
     """
     if request.method == 'POST':
         LOG.info('Parsed POST request body.')
-        return request.method, await request.json()  # we are always expecting JSON
+        return request.method, await request.json(loads=orjson.loads)  # we are always expecting JSON
 
     if request.method == 'GET':
         # LOG.info(f"This is the request object: {request}")
@@ -48,9 +48,8 @@ async def parse_request_object(request):
             items['datasetIds'] = request.rel_url.query.get('datasetIds').split(',')
         elif 'filters' in items:
             items['filters'] = request.rel_url.query.get('filters').split(',')
-        obj = json.dumps(items)
         LOG.info('Parsed GET request parameters.')
-        return request.method, json.loads(obj)
+        return request.method, items
 
 
 async def parse_basic_request_object(request):
@@ -60,15 +59,14 @@ async def parse_basic_request_object(request):
     """
     if request.method == 'POST':
         LOG.info('Parsed POST request body.')
-        return request.method, await request.json()  # we are always expecting JSON
+        return request.method, await request.json(loads=orjson.loads)  # we are always expecting JSON
 
     if request.method == 'GET':        
         # GET parameters are returned as strings
         items = {k: v for k, v in request.rel_url.query.items() if k != "levels"}
         items.update({k: v.lower() for k, v in request.rel_url.query.items() if k == "levels"})
-        obj = json.dumps(items)
         LOG.info('Parsed GET request parameters.')
-        return request.method, json.loads(obj)
+        return request.method, items
 
 
 def extend_with_default(validator_class):
@@ -0,0 +1,114 @@
+import asyncio
+import unittest
+from unittest import mock
+
+import aiohttp
+
+from beacon_api.utils import polyvalent_functions
+from beacon_api.utils.polyvalent_functions import parse_filters_request, fetch_cellbase, fetch_dbsnp, fetch_dbsnp_summaries
+
+
+class MockResponse:
+    """Response of the mocked HTTP session, with the given status and body."""
+
+    def __init__(self, status, body):
+        self.status = status
+        self.body = body
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        pass
+
+    def raise_for_status(self):
+        if self.status >= 400:
+            raise aiohttp.ClientResponseError(None, (), status=self.status)
+
+    async def read(self):
+        return self.body
+
+
+class MockSession:
+    """HTTP session that answers the requests with the given responses, in order."""
+
+    def __init__(self, *responses):
+        self.responses = list(responses)
+        self.urls = []
+
+    def get(self, url):
+        self.urls.append(url)
+        return MockResponse(*self.responses.pop(0))
+
+
+class TestParseFiltersRequest(unittest.TestCase):
+    """Test the parsing of the filters given in the query."""
+
+    def test_ontology_term(self):
+        """A plain filter is split into ontology and term."""
+        self.assertEqual(parse_filters_request(['NCIT:C48725']), [['NCIT', 'C48725']])
+
+    def test_operators(self):
+        """A filter with an operator is split into ontology, term, operator and value."""
+        self.assertEqual(parse_filters_request(['OBI:0002046>=5', 'A:B<=2', 'A:B=x', 'A:B>1', 'A:B<1']),
+                         [['OBI', '0002046', '>=', '5'], ['A', 'B', '<=', '2'], ['A', 'B', '=', 'x'],
+                          ['A', 'B', '>', '1'], ['A', 'B', '<', '1']])
+
+    def test_empty_ontology_or_term(self):
+        """An empty ontology or term is kept as an empty string."""
+        self.assertEqual(parse_filters_request([':B', 'A:', 'A:>=5']),
+                         [['', 'B'], ['A', ''], ['A', '', '>=', '5']])
+
+    def test_extra_separators(self):
+        """Anything after a second ':' or a second operator is dropped."""
+        self.assertEqual(parse_filters_request(['A:B:C', 'A:B==3', 'A:B=>3']),
+                         [['A', 'B'], ['A', 'B', '=', ''], ['A', 'B', '=', '>3']])
+
+
+class TestFetchAnnotations(unittest.IsolatedAsyncioTestCase):
+    """Test the cached fetching of the variant annotations."""
+
+    def setUp(self):
+        fetch_cellbase.cache_clear()
+        fetch_dbsnp.cache_clear()
+
+    async def test_rate_limited_reply_is_not_cached(self):
+        """A 429 reply raises and the next call fetches the API again."""
+        session = MockSession((429, b'{"error": "API rate limit exceeded"}'), (200, b'{"refsnp_id": "7"}'))
+        with self.assertRaises(aiohttp.ClientResponseError):
+            await fetch_dbsnp(session, 'rs7')
+        self.assertEqual(await fetch_dbsnp(session, 'rs7'), {'refsnp_id': '7'})
+        self.assertEqual(await fetch_dbsnp(session, 'rs7'), {'refsnp_id': '7'})
+        self.assertEqual(len(session.urls), 2)
+
+    async def test_server_error_page_is_not_cached(self):
+        """A 5xx HTML error page raises instead of being parsed as JSON."""
+        session = MockSession((503, b'<html>Service Unavailable</html>'), (200, b'{"response": []}'))
+        with self.assertRaises(aiohttp.ClientResponseError):
+            await fetch_cellbase(session, '1:10:A:T')
+        self.assertEqual(await fetch_cellbase(session, '1:10:A:T'), {'response': []})
+        self.assertEqual(len(session.urls), 2)
+
+
+class TestFetchDbsnpSummaries(unittest.IsolatedAsyncioTestCase):
+    """Test the batched fetching of the dbSNP summaries."""
+
+    async def asyncSetUp(self):
+        await polyvalent_functions.DBSNP_SUMMARIES_CACHE.clear()
+
+    async def test_failed_batch(self):
+        """A failed batch raises, and only the summaries of the successful batches are cached."""
+        session = MockSession((200, b'{"result": {"uids": ["1"], "1": {"uid": "1"}}}'),
+                              (429, b'{"error": "API rate limit exceeded"}'))
+        with mock.patch.object(polyvalent_functions, 'ESUMMARY_BATCH_SIZE', 1):
+            with self.assertRaises(aiohttp.ClientResponseError):
+                await fetch_dbsnp_summaries(session, ['rs1', 'rs2'], asyncio.Semaphore(1))
+            session.responses.append((200, b'{"result": {"uids": ["2"], "2": {"uid": "2"}}}'))
+            summaries = await fetch_dbsnp_summaries(session, ['rs1', 'rs2'], asyncio.Semaphore(1))
+        self.assertEqual(summaries, {'rs1': {'uid': '1'}, 'rs2': {'uid': '2'}})
+        self.assertEqual(len(session.urls), 3)
+        self.assertTrue(session.urls[2].endswith('id=2'))
+
+
+if __name__ == '__main__':
+    unittest.main()